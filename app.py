@@ -2,7 +2,8 @@ import logging
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
-from config import DATABASE_URL, SECRET_KEY
+from config import DATABASE_URL, SECRET_KEY, SQLITE_MODE
+from sqlite_mode import enable as enable_sqlite_mode
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -26,6 +27,10 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
 db.init_app(app)
 
 with app.app_context():
+    # WAL journaling and a single writer thread for SQLite, before the first connection
+    if SQLITE_MODE and db.engine.dialect.name == 'sqlite':
+        enable_sqlite_mode(db.engine)
+
     # Import models here so their tables will be created
     import models  # noqa: F401
     db.create_all()
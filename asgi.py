@@ -0,0 +1,244 @@
+"""
+Async (ASGI) entry point.
+
+Serves the same pages as main.py, but the request path never blocks a worker:
+geolocation goes through the pooled geolocation.AsyncGeolocationClient and
+database access uses SQLAlchemy's asyncio extension (asyncpg on PostgreSQL,
+aiosqlite on SQLite).
+A single worker can therefore hold hundreds of requests that are waiting on
+ip-api or the database.
+
+Run it with an ASGI server, for example:
+
+    hypercorn --bind 0.0.0.0:5000 --workers 2 asgi:app
+
+The sync mode (gunicorn main:app) is unchanged and remains the default.
+"""
+import asyncio
+import logging
+import time
+from quart import Quart, render_template, request, flash, redirect, url_for, jsonify, Response
+from sqlalchemy import func, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from email_validator import validate_email, EmailNotValidError
+from config import (
+    ASYNC_DB_POOL_SIZE,
+    ASYNC_HTTP_MAX_CONNECTIONS,
+    DATABASE_URL,
+    LIVE_STREAM_TIMEOUT,
+    SECRET_KEY,
+    SQLITE_MODE,
+)
+from app import app as flask_app, db
+from geolocation import AsyncGeolocationClient
+from live import HEARTBEAT_INTERVAL, ensure_notify_trigger, hub
+from search import ensure_search_index
+from sqlite_mode import configure_sqlite, save_async
+from stats_cache import ensure_counter
+from models import Visitor, ContactSubmission, VisitorRollup
+import sketches  # records committed visits into the unique visitor sketches
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+def async_database_url(url):
+    """
+    Translate the sync DATABASE_URL into the equivalent async driver URL
+    """
+    url = make_url(url)
+    if url.get_backend_name() == 'postgresql':
+        query = dict(url.query)
+        # asyncpg spells libpq's sslmode as ssl
+        sslmode = query.pop('sslmode', None)
+        if sslmode:
+            query['ssl'] = sslmode
+        # The Neon pooler runs in transaction mode, which breaks prepared statement caching
+        query['prepared_statement_cache_size'] = '0'
+        return url.set(drivername='postgresql+asyncpg', query=query)
+    if url.get_backend_name() == 'sqlite':
+        return url.set(drivername='sqlite+aiosqlite')
+    return url
+
+
+app = Quart(__name__)
+app.secret_key = SECRET_KEY
+
+engine = create_async_engine(
+    async_database_url(DATABASE_URL),
+    pool_size=ASYNC_DB_POOL_SIZE,
+    pool_recycle=300,
+    pool_pre_ping=True,
+)
+if SQLITE_MODE and engine.dialect.name == 'sqlite':
+    configure_sqlite(engine.sync_engine)
+Session = async_sessionmaker(engine, expire_on_commit=False)
+geolocator = None
+
+
+def _ensure_schema_extras():
+    # Same startup work as main.py: search index, visit notifications and visitor counter
+    with flask_app.app_context():
+        ensure_search_index()
+        ensure_notify_trigger()
+        ensure_counter()
+
+
+@app.before_serving
+async def prepare_database():
+    await asyncio.to_thread(_ensure_schema_extras)
+
+
+@app.before_serving
+async def open_geolocator():
+    global geolocator
+    geolocator = AsyncGeolocationClient(pool_size=ASYNC_HTTP_MAX_CONNECTIONS)
+
+
+@app.after_serving
+async def close_geolocator():
+    await geolocator.aclose()
+    await engine.dispose()
+
+
+@app.route('/')
+async def index():
+    logger.debug("Rendering index page")
+    current_visitor = None
+
+    async with Session() as session:
+        # Archived months are counted from their rollups
+        total_visitors = (await session.scalar(select(func.count()).select_from(Visitor))
+                          + await session.scalar(select(func.coalesce(func.sum(VisitorRollup.visits), 0))))
+
+        try:
+            client_ip = request.remote_addr
+            new_visitor = Visitor(ip_address=client_ip, **await geolocator.lookup(client_ip))
+
+            await save_async(session, new_visitor)
+            hub.notify()
+
+            # Set the current visitor for display
+            current_visitor = new_visitor
+        except Exception as e:
+            await session.rollback()
+            logger.error(f"Error recording visitor: {str(e)}")
+
+    return await render_template('index.html', total_visitors=total_visitors, current_visitor=current_visitor)
+
+
+@app.route('/flash-news')
+async def flash_news():
+    return await render_template('flash_news.html')
+
+
+@app.route('/visitor-stats')
+async def visitor_stats():
+    # Get visitors in reverse chronological order (newest first)
+    async with Session() as session:
+        visitors = (await session.scalars(select(Visitor).order_by(Visitor.visit_time.desc()))).all()
+        archived = (await session.execute(
+            select(VisitorRollup.country, func.sum(VisitorRollup.visits)).group_by(VisitorRollup.country)
+        )).all()
+
+    # Get statistics by country, starting from the archived months
+    country_stats = {}
+    for country, visits in archived:
+        country_stats[country or 'Unknown'] = country_stats.get(country or 'Unknown', 0) + visits
+    for visitor in visitors:
+        country = visitor.country or 'Unknown'
+        country_stats[country] = country_stats.get(country, 0) + 1
+    total_visitors = sum(country_stats.values())
+
+    return await render_template('visitor_stats.html',
+                                 total_visitors=total_visitors,
+                                 visitors=visitors,
+                                 country_stats=country_stats)
+
+
+def _unique_visitors(days):
+    # Sketches are read through the sync session, so this runs in a thread with the Flask app context
+    with flask_app.app_context():
+        try:
+            return sketches.unique_visitors(days=days)
+        finally:
+            db.session.remove()
+
+
+@app.route('/visitor-stats/unique')
+async def visitor_stats_unique():
+    days = min(max(request.args.get('days', 30, type=int), 1), sketches.MAX_DAYS)
+    return jsonify(await asyncio.to_thread(_unique_visitors, days))
+
+
+@app.route('/visitor-stats/stream')
+async def visitor_stream():
+    subscription = hub.subscribe()
+    if subscription is None:
+        return Response('Too many live clients', status=503, headers={'Retry-After': '30'})
+
+    async def events():
+        # Same events as the sync stream, but waiting never holds a thread
+        try:
+            yield f"retry: {int(hub.poll_interval * 1000) + 1000}\n\n"
+            deadline = time.monotonic() + LIVE_STREAM_TIMEOUT
+            while (remaining := deadline - time.monotonic()) > 0:
+                message = await subscription.get_async(min(HEARTBEAT_INTERVAL, remaining))
+                yield message if message is not None else ': keepalive\n\n'
+        finally:
+            hub.unsubscribe(subscription)
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/metrics/geolocation')
+async def geolocation_metrics():
+    return jsonify(geolocator.metrics())
+
+
+@app.route('/contact', methods=['POST'])
+async def contact():
+    try:
+        form = await request.form
+        name = form.get('name')
+        email = form.get('email')
+        message = form.get('message')
+
+        if not all([name, email, message]):
+            await flash('Please fill in all fields', 'error')
+            return redirect(url_for('index', _anchor='contact'))
+
+        # Validate email (deliverability checks would block on DNS)
+        try:
+            validate_email(email, check_deliverability=False)
+        except EmailNotValidError:
+            await flash('Please enter a valid email address', 'error')
+            return redirect(url_for('index', _anchor='contact'))
+
+        client_ip = request.remote_addr
+        new_submission = ContactSubmission(
+            name=name,
+            email=email,
+            message=message,
+            ip_address=client_ip,
+            **await geolocator.lookup(client_ip)
+        )
+
+        async with Session() as session:
+            await save_async(session, new_submission)
+        logger.info(f"Saved contact submission from {name} <{email}> to database")
+
+        await flash('Thank you for your message! We will get back to you soon.', 'success')
+        return redirect(url_for('index', _anchor='contact'))
+
+    except Exception as e:
+        logger.error(f"Error in contact form: {str(e)}")
+        await flash('An error occurred. Please try again later.', 'error')
+        return redirect(url_for('index', _anchor='contact'))
+
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,27 @@
+"""
+Background threads used by the live hub, the sketch buffer and the SQLite writer.
+"""
+import threading
+
+
+class LazyThread:
+    """
+    Daemon thread started on first use rather than at import, so under
+    gunicorn it runs in the worker process and not in the master it forks from.
+    A thread that died is started again on the next use.
+    """
+
+    def __init__(self, target, name):
+        self.target = target
+        self.name = name
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.target, name=self.name, daemon=True)
+                self._thread.start()
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
@@ -0,0 +1,297 @@
+"""
+Benchmarks for the site.
+
+    python benchmark.py stub-geo --port 5100 --delay 0.2
+        Fake ip-api server with a fixed response delay, so runs are
+        reproducible and do not hit the real rate limit. Point the app at it
+        with GEOLOCATION_URL=http://127.0.0.1:5100/json/{ip}
+
+    python benchmark.py concurrency --url http://127.0.0.1:5000/ --concurrency 200
+        Load a running server with N concurrent clients and report throughput
+        and latency. Compare `gunicorn -w 2 main:app` with
+        `hypercorn -w 2 asgi:app` to see the concurrency gain of the async mode.
+
+    python benchmark.py search --rows 1000000
+        Seed a database (a throwaway SQLite file unless --database-url is
+        given) with synthetic contact submissions and time ranked full-text
+        searches against it.
+
+    python benchmark.py sqlite-writes --processes 4 --threads 8 --seconds 10
+        Record visits into a throwaway SQLite file from several processes and
+        threads, once with SQLITE_MODE off and once with it on, and report
+        the sustained write rate and 'database is locked' errors of each.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import random
+import statistics
+import string
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def run_stub_geo(args):
+    """
+    Serve a fake ip-api response after a fixed delay
+    """
+    body = json.dumps({
+        'status': 'success',
+        'country': 'India',
+        'regionName': 'Uttar Pradesh',
+        'city': 'Ghaziabad',
+    }).encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            time.sleep(args.delay)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), Handler)
+    logger.info(f"Stub geolocation server on port {args.port} with {args.delay}s delay")
+    server.serve_forever()
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[max(int(len(values) * fraction) - 1, 0)]
+
+
+async def _load(url, concurrency, total):
+    import httpx
+
+    latencies = []
+    errors = 0
+    remaining = iter(range(total))
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        async def worker():
+            nonlocal errors
+            for _ in remaining:
+                start = time.perf_counter()
+                try:
+                    response = await client.get(url)
+                    if response.status_code >= 500:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    return latencies, errors, elapsed
+
+
+def run_concurrency(args):
+    """
+    Fire requests from N concurrent clients and report throughput
+    """
+    latencies, errors, elapsed = asyncio.run(_load(args.url, args.concurrency, args.requests))
+    print(f"url:          {args.url}")
+    print(f"concurrency:  {args.concurrency}")
+    print(f"requests:     {len(latencies)} ({errors} errors)")
+    print(f"throughput:   {len(latencies) / elapsed:.1f} req/s")
+    print(f"latency p50:  {statistics.median(latencies) * 1000:.1f} ms")
+    print(f"latency p95:  {_percentile(latencies, 0.95) * 1000:.1f} ms")
+
+
+def run_search(args):
+    """
+    Seed synthetic contact submissions and time search queries against them
+    """
+    os.environ['DATABASE_URL'] = args.database_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'search.db')}"
+    from datetime import datetime
+    from app import app, db
+    from models import ContactSubmission
+    from search import ensure_search_index, search_submissions
+
+    rng = random.Random(42)
+    vocabulary = [''.join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 9))) for _ in range(20000)]
+    # Zipf-like word frequencies, like natural text
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+
+    with app.app_context():
+        table = ContactSubmission.__table__
+        existing = db.session.query(ContactSubmission).count()
+        start = time.perf_counter()
+        with db.engine.begin() as conn:
+            for offset in range(existing, args.rows, 10000):
+                conn.execute(table.insert(), [{
+                    'name': ' '.join(rng.choices(vocabulary[:2000], k=2)).title(),
+                    'email': f"user{number}@{rng.choice(vocabulary[:500])}.com",
+                    'message': ' '.join(rng.choices(vocabulary, weights=weights, k=args.words)),
+                    'submission_time': datetime.utcnow(),
+                } for number in range(offset, min(offset + 10000, args.rows))])
+        ensure_search_index()
+        logger.info(f"Seeded {max(args.rows - existing, 0)} submissions in {time.perf_counter() - start:.1f}s")
+
+        queries = []
+        for _ in range(args.queries):
+            kind = rng.random()
+            if kind < 0.4:
+                queries.append(rng.choice(vocabulary[1000:]))
+            elif kind < 0.7:
+                queries.append(rng.choice(vocabulary[:50]))
+            elif kind < 0.9:
+                queries.append(' '.join(rng.choices(vocabulary[:2000], k=2)))
+            else:
+                queries.append(f"user{rng.randrange(args.rows)}@")
+
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            search_submissions(query, page=1, per_page=20)
+            latencies.append(time.perf_counter() - start)
+
+        print(f"database:     {db.engine.url.render_as_string(hide_password=True)}")
+    print(f"submissions:  {args.rows}")
+    print(f"queries:      {len(latencies)}")
+    print(f"latency p50:  {statistics.median(latencies) * 1000:.2f} ms")
+    print(f"latency p95:  {_percentile(latencies, 0.95) * 1000:.2f} ms")
+    print(f"latency max:  {max(latencies) * 1000:.2f} ms")
+
+
+def _write_visits(database_url, sqlite_mode, threads, seconds, results):
+    """
+    Process body for the SQLite write benchmark
+    """
+    os.environ['DATABASE_URL'] = database_url
+    os.environ['SQLITE_MODE'] = 'on' if sqlite_mode else 'off'
+    logging.disable(logging.CRITICAL)
+    from sqlalchemy.exc import OperationalError
+    from app import app, db
+    from models import Visitor
+    from sqlite_mode import save
+
+    counts = {'written': 0, 'locked': 0, 'errors': 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def writer(number):
+        written = locked = errors = 0
+        with app.app_context():
+            while time.monotonic() < deadline:
+                visitor = Visitor(ip_address=f"10.{number}.{written % 250}.{written // 250 % 250}",
+                                  country='India', region='Uttar Pradesh', city='Ghaziabad')
+                try:
+                    save(db.session, visitor)
+                    written += 1
+                except OperationalError as e:
+                    db.session.rollback()
+                    if 'locked' in str(e):
+                        locked += 1
+                    else:
+                        errors += 1
+        with lock:
+            counts['written'] += written
+            counts['locked'] += locked
+            counts['errors'] += errors
+
+    workers = [threading.Thread(target=writer, args=(number,)) for number in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    results.put(counts)
+
+
+def run_sqlite_writes(args):
+    """
+    Compare the sustained SQLite write rate with and without SQLite mode
+    """
+    context = multiprocessing.get_context('spawn')
+    for sqlite_mode in (False, True):
+        database_url = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'writes.db')}"
+        # Create the schema once before the writers race for it, the queue must outlive the child's start
+        setup_results = context.Queue()
+        setup = context.Process(target=_write_visits, args=(database_url, sqlite_mode, 0, 0, setup_results))
+        setup.start()
+        setup.join()
+        if setup.exitcode != 0:
+            raise SystemExit(f"Creating the schema failed with exit code {setup.exitcode}")
+
+        results = context.Queue()
+        processes = [
+            context.Process(target=_write_visits, args=(database_url, sqlite_mode, args.threads, args.seconds, results))
+            for _ in range(args.processes)
+        ]
+        for process in processes:
+            process.start()
+        totals = {'written': 0, 'locked': 0, 'errors': 0}
+        for _ in processes:
+            try:
+                counts = results.get(timeout=args.seconds + 60)
+            except queue.Empty:
+                break
+            for key, value in counts.items():
+                totals[key] += value
+        for process in processes:
+            process.join(timeout=10)
+        failed = [process.exitcode for process in processes if process.exitcode != 0]
+        if failed:
+            logger.error(f"{len(failed)} writer processes failed (exit codes {failed}), totals are incomplete")
+
+        print(f"sqlite mode:  {'on' if sqlite_mode else 'off'}")
+        print(f"writers:      {args.processes} processes x {args.threads} threads for {args.seconds}s")
+        print(f"written:      {totals['written']} ({totals['written'] / args.seconds:.1f} rows/s)")
+        print(f"locked:       {totals['locked']}")
+        print(f"other errors: {totals['errors']}")
+        print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    stub = commands.add_parser('stub-geo', help='run a slow fake ip-api server')
+    stub.add_argument('--port', type=int, default=5100)
+    stub.add_argument('--delay', type=float, default=0.2)
+    stub.set_defaults(func=run_stub_geo)
+
+    load = commands.add_parser('concurrency', help='load a running server with concurrent clients')
+    load.add_argument('--url', default='http://127.0.0.1:5000/')
+    load.add_argument('--concurrency', type=int, default=200)
+    load.add_argument('--requests', type=int, default=2000)
+    load.set_defaults(func=run_concurrency)
+
+    search = commands.add_parser('search', help='time full-text search over seeded contact submissions')
+    search.add_argument('--rows', type=int, default=1000000)
+    search.add_argument('--words', type=int, default=30, help='words per message')
+    search.add_argument('--queries', type=int, default=200)
+    search.add_argument('--database-url', help='defaults to a throwaway SQLite file')
+    search.set_defaults(func=run_search)
+
+    writes = commands.add_parser('sqlite-writes', help='compare SQLite write throughput with and without SQLite mode')
+    writes.add_argument('--processes', type=int, default=4)
+    writes.add_argument('--threads', type=int, default=8)
+    writes.add_argument('--seconds', type=float, default=10)
+    writes.set_defaults(func=run_sqlite_writes)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -26,17 +26,27 @@ def create_all_tables():
             conn = psycopg2.connect(os.environ.get("DATABASE_URL"))
             cursor = conn.cursor()
             
+            # Create location lookup table
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS location (
+                id SERIAL PRIMARY KEY,
+                country VARCHAR(100) NOT NULL DEFAULT '',
+                region VARCHAR(100) NOT NULL DEFAULT '',
+                city VARCHAR(100) NOT NULL DEFAULT '',
+                UNIQUE (country, region, city)
+            )
+            """)
+
             # Create visitor table
             cursor.execute("""
             CREATE TABLE IF NOT EXISTS visitor (
                 id SERIAL PRIMARY KEY,
-                ip_address VARCHAR(50) NOT NULL,
+                ip_address INET NOT NULL,
                 visit_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                country VARCHAR(100),
-                city VARCHAR(100),
-                region VARCHAR(100)
+                location_id INTEGER REFERENCES location (id)
             )
             """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS ix_visitor_location_id ON visitor (location_id)")
             
             # Create contact_submission table
             cursor.execute("""
@@ -46,12 +56,11 @@ def create_all_tables():
                 email VARCHAR(120) NOT NULL,
                 message TEXT NOT NULL,
                 submission_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                ip_address VARCHAR(50),
-                country VARCHAR(100),
-                city VARCHAR(100),
-                region VARCHAR(100)
+                ip_address INET,
+                location_id INTEGER REFERENCES location (id)
             )
             """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS ix_contact_submission_location_id ON contact_submission (location_id)")
             
             conn.commit()
             logger.info("SQL tables creation completed")
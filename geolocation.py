@@ -0,0 +1,251 @@
+"""
+IP geolocation client shared by the sync (main.py) and async (asgi.py) routes.
+
+Lookups go through a keep-alive connection pool and are bounded by a latency
+budget. Consecutive upstream failures open a circuit breaker, and ip-api's
+rate-limit headers (X-Rl requests left, X-Ttl seconds until reset) pause
+lookups until the window resets, so while ip-api is unhealthy a page view
+costs nothing instead of waiting for the timeout. Every lookup is counted by
+outcome, see GeolocationClient.metrics().
+"""
+import asyncio
+import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from config import (
+    GEOLOCATION_URL,
+    GEOLOCATION_TIMEOUT,
+    GEOLOCATION_POOL_SIZE,
+    GEOLOCATION_FAILURE_THRESHOLD,
+    GEOLOCATION_RESET_TIMEOUT,
+)
+
+logger = logging.getLogger(__name__)
+
+# ip-api answers these with status: fail, they are not upstream errors
+NO_RESULT_MESSAGES = {'private range', 'reserved range', 'invalid query'}
+
+# Used when a 429 arrives without an X-Ttl header
+DEFAULT_RATE_LIMIT_WAIT = 60
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker.
+
+    Closed: calls pass. After `failure_threshold` consecutive failures it opens
+    and rejects calls for `reset_timeout` seconds, then lets a single probe
+    through (half-open). A successful probe closes it, a failed one re-opens it.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._blocked_until = 0.0
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return 'open'
+            return 'half-open'
+
+    def allow(self):
+        with self._lock:
+            now = time.monotonic()
+            if now < self._blocked_until:
+                return False
+            if self._opened_at is None:
+                return True
+            if now - self._opened_at < self.reset_timeout or self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logger.warning(f"Geolocation circuit opened after {self._failures} consecutive failures")
+                self._opened_at = time.monotonic()
+
+    def block_for(self, seconds):
+        """
+        Reject calls for `seconds`, used when the upstream rate limit is exhausted
+        """
+        with self._lock:
+            self._probing = False
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+
+class BaseGeolocationClient:
+    """
+    Breaker, rate-limit and response handling shared by the sync and async clients
+    """
+
+    def __init__(self, url=GEOLOCATION_URL, timeout=GEOLOCATION_TIMEOUT,
+                 failure_threshold=GEOLOCATION_FAILURE_THRESHOLD,
+                 reset_timeout=GEOLOCATION_RESET_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self._counters = Counter()
+        self._counters_lock = threading.Lock()
+
+    def _count(self, outcome):
+        with self._counters_lock:
+            self._counters[outcome] += 1
+
+    def metrics(self):
+        """
+        Per-outcome lookup counters plus the breaker state
+        """
+        with self._counters_lock:
+            counters = dict(self._counters)
+        return {'outcomes': counters, 'circuit': self.breaker.state}
+
+    def _check_rate_limit(self, headers):
+        remaining = headers.get('X-Rl')
+        if remaining is not None and remaining.strip() == '0':
+            ttl = headers.get('X-Ttl')
+            wait = int(ttl) if ttl and ttl.isdigit() else DEFAULT_RATE_LIMIT_WAIT
+            logger.warning(f"Geolocation rate limit exhausted, pausing lookups for {wait}s")
+            self.breaker.block_for(wait)
+
+    def _handle_response(self, status_code, headers, json_body):
+        """
+        Turn an upstream response into location fields, updating breaker and counters
+        """
+        if status_code == 429:
+            ttl = headers.get('X-Ttl')
+            self.breaker.block_for(int(ttl) if ttl and ttl.isdigit() else DEFAULT_RATE_LIMIT_WAIT)
+            self._count('rate_limited')
+            return {}
+
+        self._check_rate_limit(headers)
+
+        if status_code != 200:
+            self.breaker.record_failure()
+            self._count('http_error')
+            return {}
+
+        data = json_body()
+        logger.debug(f"IP API response: {data}")
+        if data.get('status') == 'fail':
+            if data.get('message') in NO_RESULT_MESSAGES:
+                self.breaker.record_success()
+                self._count('no_result')
+            else:
+                self.breaker.record_failure()
+                self._count('upstream_fail')
+            return {}
+
+        self.breaker.record_success()
+        self._count('success')
+        return {
+            'country': data.get('country', 'Unknown'),
+            'city': data.get('city', 'Unknown'),
+            'region': data.get('regionName', 'Unknown'),
+        }
+
+
+class GeolocationClient(BaseGeolocationClient):
+    """
+    Blocking client backed by a keep-alive requests.Session.
+
+    requests only bounds each connect and read separately, so a slow DNS
+    answer or a slowly dripping body could take several timeouts in total.
+    Requests run on a small thread pool instead and the caller stops waiting
+    once `timeout` has passed since the lookup started.
+    """
+
+    def __init__(self, pool_size=GEOLOCATION_POOL_SIZE, **kwargs):
+        super().__init__(**kwargs)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='geolocation')
+
+    def lookup(self, ip):
+        """
+        Location fields for `ip`, or an empty dict when unavailable
+        """
+        if not self.breaker.allow():
+            self._count('short_circuit')
+            return {}
+        future = self._executor.submit(self.session.get, self.url.format(ip=ip), timeout=self.timeout)
+        try:
+            # Total deadline, including time spent waiting for a free pool thread
+            response = future.result(timeout=self.timeout)
+            return self._handle_response(response.status_code, response.headers, response.json)
+        except (requests.Timeout, TimeoutError):
+            future.cancel()
+            self.breaker.record_failure()
+            self._count('timeout')
+        except Exception as e:
+            self.breaker.record_failure()
+            self._count('error')
+            logger.error(f"Error fetching location data: {str(e)}")
+        return {}
+
+
+class AsyncGeolocationClient(BaseGeolocationClient):
+    """
+    Non-blocking client backed by a pooled httpx.AsyncClient
+    """
+
+    def __init__(self, pool_size=GEOLOCATION_POOL_SIZE, **kwargs):
+        import httpx
+
+        super().__init__(**kwargs)
+        self._httpx = httpx
+        self.client = httpx.AsyncClient(
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=max(1, pool_size // 5)),
+        )
+
+    async def lookup(self, ip):
+        """
+        Location fields for `ip`, or an empty dict when unavailable
+        """
+        if not self.breaker.allow():
+            self._count('short_circuit')
+            return {}
+        try:
+            # httpx timeouts are per phase too, wait_for bounds the whole lookup
+            response = await asyncio.wait_for(self.client.get(self.url.format(ip=ip)), self.timeout)
+            return self._handle_response(response.status_code, response.headers, response.json)
+        except (self._httpx.TimeoutException, TimeoutError):
+            self.breaker.record_failure()
+            self._count('timeout')
+        except Exception as e:
+            self.breaker.record_failure()
+            self._count('error')
+            logger.error(f"Error fetching location data: {str(e)}")
+        return {}
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+# Process-wide client used by the sync routes
+geolocator = GeolocationClient()
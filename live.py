@@ -0,0 +1,295 @@
+"""
+Live visitor events over Server-Sent Events.
+
+One VisitorHub per worker process runs a single poller thread that reads new
+visitor rows and fans them out to every connected client, so clients add no
+database load of their own. On PostgreSQL the poller LISTENs for the
+`visitor_events` notification sent by an insert trigger and wakes up as soon
+as a visit is committed by any worker; on SQLite it polls every
+LIVE_POLL_INTERVAL seconds and is woken early by visits recorded in the same
+process (see VisitorHub.notify).
+
+Each client gets a bounded buffer. A client that falls behind has its
+backlog dropped, the counter event that follows carries the current total,
+so slow clients never hold memory or slow down the others.
+"""
+import asyncio
+import json
+import logging
+import select
+import threading
+import time
+from collections import deque
+from sqlalchemy import text
+from app import app, db
+from background import LazyThread
+from config import (
+    DATABASE_URL,
+    LIVE_BUFFER_SIZE,
+    LIVE_LISTEN_DATABASE_URL,
+    LIVE_MAX_CLIENTS,
+    LIVE_POLL_INTERVAL,
+    LIVE_STREAM_TIMEOUT,
+)
+from models import Visitor
+from retention import archived_visits
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'visitor_events'
+HEARTBEAT_INTERVAL = 15
+# Recount the table now and then so the total follows retention deletes
+RESYNC_INTERVAL = 300
+
+POSTGRESQL_TRIGGER = [
+    f"""
+    CREATE OR REPLACE FUNCTION notify_visitor_insert() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('{CHANNEL}', NEW.id::text);
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    "CREATE OR REPLACE TRIGGER visitor_notify_insert AFTER INSERT ON visitor FOR EACH ROW EXECUTE FUNCTION notify_visitor_insert()",
+]
+
+
+def ensure_notify_trigger():
+    """
+    Install the insert notification trigger (PostgreSQL only)
+    """
+    if db.engine.dialect.name != 'postgresql':
+        return
+    with db.engine.begin() as conn:
+        # Creating a trigger locks the hot visitor table, so only do it once, not on every worker start
+        exists = conn.execute(text(
+            "SELECT 1 FROM pg_trigger WHERE tgname = 'visitor_notify_insert' AND tgrelid = 'visitor'::regclass"
+        )).first()
+        if exists:
+            return
+        for statement in POSTGRESQL_TRIGGER:
+            conn.execute(text(statement))
+
+
+def format_event(event, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data)}")
+    return '\n'.join(lines) + '\n\n'
+
+
+class Subscription:
+    """
+    Bounded per-client event buffer
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._events = deque()
+        self._condition = threading.Condition()
+        # (loop, asyncio.Event) of a get_async() call waiting for an event
+        self._async_waiter = None
+
+    def offer(self, message):
+        with self._condition:
+            if len(self._events) >= self.maxsize:
+                # Slow client: drop its backlog rather than buffer without bound
+                self.dropped += len(self._events)
+                self._events.clear()
+            self._events.append(message)
+            self._condition.notify()
+            waiter = self._async_waiter
+        if waiter is not None:
+            loop, wakeup = waiter
+            try:
+                loop.call_soon_threadsafe(wakeup.set)
+            except RuntimeError:
+                # The event loop has already closed
+                pass
+
+    def get(self, timeout):
+        with self._condition:
+            if not self._events:
+                self._condition.wait(timeout)
+            return self._events.popleft() if self._events else None
+
+    async def get_async(self, timeout):
+        """
+        get() for the async app, waits without blocking the event loop or a thread
+        """
+        wakeup = asyncio.Event()
+        with self._condition:
+            if self._events:
+                return self._events.popleft()
+            self._async_waiter = (asyncio.get_running_loop(), wakeup)
+        try:
+            await asyncio.wait_for(wakeup.wait(), timeout)
+        except TimeoutError:
+            pass
+        finally:
+            with self._condition:
+                self._async_waiter = None
+        with self._condition:
+            return self._events.popleft() if self._events else None
+
+
+class VisitorHub:
+    """
+    Fans new-visit and counter events out from a single poller thread to all subscribers
+    """
+
+    def __init__(self, poll_interval=LIVE_POLL_INTERVAL, buffer_size=LIVE_BUFFER_SIZE,
+                 max_clients=LIVE_MAX_CLIENTS):
+        self.poll_interval = poll_interval
+        self.buffer_size = buffer_size
+        self.max_clients = max_clients
+        self.total = None
+        self.last_id = None
+        self._synced_at = 0.0
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = LazyThread(self._run, 'visitor-hub')
+
+    def subscribe(self):
+        """
+        Register a client, returns None when the hub is full
+        """
+        with self._lock:
+            if len(self._subscribers) >= self.max_clients:
+                return None
+            subscription = Subscription(self.buffer_size)
+            self._subscribers.add(subscription)
+            total = self.total
+        self._thread.ensure_started()
+        if total is not None:
+            subscription.offer(format_event('counter', {'total': total}))
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def notify(self):
+        """
+        Wake the poller after a visit was committed in this process
+        """
+        self._wake.set()
+
+    def publish(self, message):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            subscription.offer(message)
+
+    def stream(self, subscription):
+        """
+        SSE response body for one client, ends after LIVE_STREAM_TIMEOUT so
+        the browser reconnects and the worker thread is released
+        """
+        try:
+            yield f"retry: {int(self.poll_interval * 1000) + 1000}\n\n"
+            deadline = time.monotonic() + LIVE_STREAM_TIMEOUT
+            while (remaining := deadline - time.monotonic()) > 0:
+                message = subscription.get(min(HEARTBEAT_INTERVAL, remaining))
+                yield message if message is not None else ': keepalive\n\n'
+        finally:
+            self.unsubscribe(subscription)
+
+    def _sync(self):
+        self.total = Visitor.query.count() + archived_visits()
+        self.last_id = db.session.query(db.func.max(Visitor.id)).scalar() or 0
+        self._synced_at = time.monotonic()
+        self.publish(format_event('counter', {'total': self.total}))
+
+    def _poll(self):
+        """
+        Publish visits committed since the last poll, returns True if more are waiting
+        """
+        with self._lock:
+            idle = not self._subscribers
+        if idle:
+            # Nobody is listening, resync from scratch when someone is
+            self.total = None
+            return False
+        if self.total is None or time.monotonic() - self._synced_at > RESYNC_INTERVAL:
+            self._sync()
+            return False
+
+        visitors = (Visitor.query.filter(Visitor.id > self.last_id)
+                    .order_by(Visitor.id).limit(self.buffer_size).all())
+        if not visitors:
+            return False
+        for visitor in visitors:
+            self.publish(format_event('visit', {
+                'id': visitor.id,
+                'country': visitor.country,
+                'region': visitor.region,
+                'city': visitor.city,
+                'visit_time': visitor.visit_time.isoformat() if visitor.visit_time else None,
+            }, event_id=visitor.id))
+        self.last_id = visitors[-1].id
+        self.total += len(visitors)
+        self.publish(format_event('counter', {'total': self.total}))
+        return len(visitors) == self.buffer_size
+
+    def _listen_connection(self):
+        if db.engine.dialect.name != 'postgresql':
+            return None
+        try:
+            import psycopg2
+
+            # LISTEN needs a session, so it cannot go through a transaction-mode pooler
+            conn = psycopg2.connect(LIVE_LISTEN_DATABASE_URL or DATABASE_URL)
+            conn.autocommit = True
+            conn.cursor().execute(f"LISTEN {CHANNEL}")
+            return conn
+        except Exception as e:
+            logger.error(f"Could not LISTEN for visitor events, polling instead: {str(e)}")
+            return None
+
+    def _wait(self, listen_conn):
+        """
+        Sleep until the next poll, returns the LISTEN connection (None once
+        lost) and whether there may be new rows
+        """
+        if listen_conn is None:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            return None, True
+        try:
+            if select.select([listen_conn], [], [], self.poll_interval)[0]:
+                listen_conn.poll()
+                notified = bool(listen_conn.notifies)
+                listen_conn.notifies.clear()
+                return listen_conn, notified
+            return listen_conn, False
+        except Exception as e:
+            logger.error(f"Lost the LISTEN connection, polling instead: {str(e)}")
+            return None, True
+
+    def _run(self):
+        with app.app_context():
+            listen_conn = self._listen_connection()
+            changed = True
+            while True:
+                more = False
+                # With LISTEN the table is only read when a visit was committed, or to resync the total
+                resync_due = time.monotonic() - self._synced_at > RESYNC_INTERVAL
+                if changed or resync_due or self.total is None:
+                    try:
+                        more = self._poll()
+                    except Exception as e:
+                        logger.error(f"Error polling visitor events: {str(e)}")
+                    finally:
+                        db.session.remove()
+                if more:
+                    continue
+                listen_conn, changed = self._wait(listen_conn)
+
+
+# Process-wide hub
+hub = VisitorHub()
@@ -1,10 +1,18 @@
 import os
+import hmac
 import logging
-import requests
-from flask import render_template, request, flash, redirect, url_for
+from flask import render_template, request, flash, redirect, url_for, jsonify, abort, Response, session, make_response
 from email_validator import validate_email, EmailNotValidError
 from app import app, db
 from models import Visitor, ContactSubmission
+from geolocation import geolocator
+from search import ensure_search_index, search_submissions
+from live import ensure_notify_trigger, hub
+from retention import archived_visits, archived_visits_by_country
+from sketches import MAX_DAYS, unique_visitors
+from sqlite_mode import save
+from stats_cache import data_version, ensure_counter, visitor_stats_cache
+from config import SEARCH_TOKEN
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -16,29 +24,25 @@ if not os.path.exists(images_dir):
     os.makedirs(images_dir)
     logger.info(f"Created images directory at {images_dir}")
 
+# Make sure the contact submission search index, visit notifications and visitor counter exist
+with app.app_context():
+    ensure_search_index()
+    ensure_notify_trigger()
+    ensure_counter()
+
 @app.route('/')
 def index():
     logger.debug("Rendering index page")
-    total_visitors = Visitor.query.count()
+    # Archived months are counted from their rollups
+    total_visitors = Visitor.query.count() + archived_visits()
     current_visitor = None
     
     try:
         client_ip = request.remote_addr
-        new_visitor = Visitor(ip_address=client_ip)
+        new_visitor = Visitor(ip_address=client_ip, **geolocator.lookup(client_ip))
 
-        try:
-            response = requests.get(f'http://ip-api.com/json/{client_ip}', timeout=5)
-            if response.status_code == 200:
-                data = response.json()
-                logger.debug(f"IP API response: {data}")
-                new_visitor.country = data.get('country', 'Unknown')
-                new_visitor.city = data.get('city', 'Unknown')
-                new_visitor.region = data.get('regionName', 'Unknown')
-        except Exception as e:
-            logger.error(f"Error fetching location data: {str(e)}")
-
-        db.session.add(new_visitor)
-        db.session.commit()
+        save(db.session, new_visitor)
+        hub.notify()
         
         # Set the current visitor for display
         current_visitor = new_visitor
@@ -53,23 +57,71 @@ def flash_news():
 
 @app.route('/visitor-stats')
 def visitor_stats():
-    # Get visitors in reverse chronological order (newest first)
-    visitors = Visitor.query.order_by(Visitor.visit_time.desc()).all()
-    total_visitors = len(visitors)
-    
-    # Get statistics by country
-    country_stats = {}
-    for visitor in visitors:
-        country = visitor.country or 'Unknown'
-        if country in country_stats:
-            country_stats[country] += 1
-        else:
-            country_stats[country] = 1
-    
-    return render_template('visitor_stats.html', 
-                          total_visitors=total_visitors, 
-                          visitors=visitors,
-                          country_stats=country_stats)
+    version = data_version()
+    etag = f"visitor-stats-{version}"
+    # Pending flash messages are rendered into the page, so it cannot be shared then
+    cacheable = '_flashes' not in session
+
+    html = None
+    if cacheable:
+        if request.if_none_match.contains(etag):
+            response = make_response('', 304)
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        html = visitor_stats_cache.get(version)
+
+    if html is None:
+        # Get visitors in reverse chronological order (newest first)
+        visitors = Visitor.query.order_by(Visitor.visit_time.desc()).all()
+
+        # Get statistics by country, starting from the archived months
+        country_stats = archived_visits_by_country()
+        for visitor in visitors:
+            country_stats[visitor.country or 'Unknown'] += 1
+        total_visitors = sum(country_stats.values())
+
+        html = render_template('visitor_stats.html', 
+                               total_visitors=total_visitors, 
+                               visitors=visitors,
+                               country_stats=country_stats)
+        if cacheable:
+            visitor_stats_cache.put(version, html)
+
+    response = make_response(html)
+    if cacheable:
+        response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/visitor-stats/unique')
+def visitor_stats_unique():
+    days = min(max(request.args.get('days', 30, type=int), 1), MAX_DAYS)
+    return jsonify(unique_visitors(days=days))
+
+@app.route('/visitor-stats/stream')
+def visitor_stream():
+    subscription = hub.subscribe()
+    if subscription is None:
+        return Response('Too many live clients', status=503, headers={'Retry-After': '30'})
+    return Response(hub.stream(subscription), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/metrics/geolocation')
+def geolocation_metrics():
+    return jsonify(geolocator.metrics())
+
+@app.route('/contact-submissions/search')
+def contact_search():
+    # Contact submissions are private, only answer requests carrying the search token
+    token = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not SEARCH_TOKEN or not hmac.compare_digest(token, SEARCH_TOKEN):
+        abort(404)
+    return jsonify(search_submissions(
+        request.args.get('q', ''),
+        page=request.args.get('page', 1, type=int),
+        per_page=request.args.get('per_page', 20, type=int),
+    ))
 
 @app.route('/contact', methods=['POST'])
 def contact():
@@ -95,24 +147,12 @@ def contact():
             name=name,
             email=email,
             message=message,
-            ip_address=client_ip
+            ip_address=client_ip,
+            **geolocator.lookup(client_ip)
         )
         
-        # Try to get location data for the submission
-        try:
-            response = requests.get(f'http://ip-api.com/json/{client_ip}', timeout=5)
-            if response.status_code == 200:
-                data = response.json()
-                logger.debug(f"IP API response for contact form: {data}")
-                new_submission.country = data.get('country', 'Unknown')
-                new_submission.city = data.get('city', 'Unknown')
-                new_submission.region = data.get('regionName', 'Unknown')
-        except Exception as e:
-            logger.error(f"Error fetching location data for contact form: {str(e)}")
-        
         # Save to the database
-        db.session.add(new_submission)
-        db.session.commit()
+        save(db.session, new_submission)
         logger.info(f"Saved contact submission from {name} <{email}> to database")
         
         # In a real implementation, you would also send the email here
@@ -0,0 +1,247 @@
+import logging
+import sys
+from sqlalchemy import text
+from app import app, db
+from models import LOCATION_FIELDS, pack_ip
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TABLES = ('visitor', 'contact_submission')
+
+# Session-local cast that returns NULL instead of failing on an unparseable address
+POSTGRESQL_TO_INET = """
+    CREATE OR REPLACE FUNCTION pg_temp.to_inet(value text) RETURNS inet AS $$
+    BEGIN
+        RETURN value::inet;
+    EXCEPTION WHEN others THEN
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql IMMUTABLE
+"""
+
+# Compact SQLite schemas, rotated visitor_YYYY_MM tables use the visitor layout
+SQLITE_SCHEMAS = {
+    'visitor': """
+        CREATE TABLE {name} (
+            id INTEGER NOT NULL PRIMARY KEY,
+            ip_address BLOB NOT NULL,
+            visit_time DATETIME,
+            location_id INTEGER REFERENCES location (id)
+        )
+    """,
+    'contact_submission': """
+        CREATE TABLE {name} (
+            id INTEGER NOT NULL PRIMARY KEY,
+            name VARCHAR(100) NOT NULL,
+            email VARCHAR(120) NOT NULL,
+            message TEXT NOT NULL,
+            submission_time DATETIME,
+            ip_address BLOB,
+            location_id INTEGER REFERENCES location (id)
+        )
+    """,
+}
+
+
+def _columns(conn, table):
+    if db.engine.dialect.name == 'postgresql':
+        rows = conn.execute(text(
+            "SELECT column_name, data_type FROM information_schema.columns WHERE table_name = :table"
+        ), {'table': table})
+        return dict(rows.all())
+    return {row[1]: row[2] for row in conn.execute(text(f"PRAGMA table_info({table})"))}
+
+
+def _tables(conn):
+    """
+    Tables to migrate, including rotated SQLite visitor tables (see retention.py)
+    """
+    tables = list(TABLES)
+    if db.engine.dialect.name == 'sqlite':
+        tables += [row[0] for row in conn.execute(text(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB 'visitor_[0-9]*'"
+        ))]
+    return tables
+
+
+def migrate_postgresql(conn, table):
+    """
+    Move locations into the location table and convert ip_address to INET in place
+    """
+    columns = _columns(conn, table)
+    if 'country' in columns:
+        has_location = ' OR '.join(f"t.{field} IS NOT NULL" for field in LOCATION_FIELDS)
+        conn.execute(text(
+            f"INSERT INTO location (country, region, city) "
+            f"SELECT DISTINCT coalesce(t.country, ''), coalesce(t.region, ''), coalesce(t.city, '') "
+            f"FROM {table} t WHERE {has_location} ON CONFLICT DO NOTHING"
+        ))
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS location_id INTEGER REFERENCES location (id)"))
+        matches = ' AND '.join(f"l.{field} = coalesce(t.{field}, '')" for field in LOCATION_FIELDS)
+        conn.execute(text(
+            f"UPDATE {table} t SET location_id = l.id FROM location l WHERE {matches} AND ({has_location})"
+        ))
+        conn.execute(text(f"ALTER TABLE {table} DROP COLUMN country, DROP COLUMN region, DROP COLUMN city"))
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table}_location_id ON {table} (location_id)"))
+        logger.info(f"Moved {table} locations into the location table")
+
+    if columns.get('ip_address') != 'inet':
+        conn.execute(text(POSTGRESQL_TO_INET))
+        invalid_ips = conn.execute(text(
+            f"SELECT count(*) FROM {table} WHERE nullif(ip_address, '') IS NOT NULL "
+            f"AND pg_temp.to_inet(ip_address) IS NULL"
+        )).scalar()
+        # Same mapping as migrate_sqlite: unparseable addresses become '::', missing ones too unless nullable
+        missing = "NULL" if table == 'contact_submission' else "'::'::inet"
+        conn.execute(text(
+            f"ALTER TABLE {table} ALTER COLUMN ip_address TYPE INET USING "
+            f"CASE WHEN nullif(ip_address, '') IS NULL THEN {missing} "
+            f"ELSE coalesce(pg_temp.to_inet(ip_address), '::'::inet) END"
+        ))
+        if invalid_ips:
+            logger.warning(f"{invalid_ips} unparseable IP addresses in {table} were stored as '::'")
+        logger.info(f"Converted {table}.ip_address to INET")
+
+
+def migrate_sqlite(conn, table):
+    """
+    Rebuild a table with binary IPs and location references, SQLite cannot alter column types
+    """
+    columns = _columns(conn, table)
+    if 'country' not in columns:
+        logger.info(f"{table} already uses the compact layout")
+        return
+
+    schema = SQLITE_SCHEMAS.get(table, SQLITE_SCHEMAS['visitor'])
+    compact_table = f"{table}_compact"
+    conn.execute(text(schema.format(name=compact_table)))
+
+    location_ids = {}
+    invalid_ips = 0
+    rows = conn.execute(text(f"SELECT * FROM {table}")).mappings().all()
+    converted = []
+    for row in rows:
+        row = dict(row)
+        location = tuple(row.pop(field) for field in LOCATION_FIELDS)
+        if any(location):
+            key = tuple(value or '' for value in location)
+            if key not in location_ids:
+                values = dict(zip(LOCATION_FIELDS, key))
+                conn.execute(text(
+                    "INSERT INTO location (country, region, city) VALUES (:country, :region, :city) "
+                    "ON CONFLICT DO NOTHING"
+                ), values)
+                location_ids[key] = conn.execute(text(
+                    "SELECT id FROM location WHERE country = :country AND region = :region AND city = :city"
+                ), values).scalar()
+            row['location_id'] = location_ids[key]
+        else:
+            row['location_id'] = None
+
+        if row.get('ip_address'):
+            try:
+                row['ip_address'] = pack_ip(row['ip_address'])
+            except ValueError:
+                invalid_ips += 1
+                row['ip_address'] = pack_ip('::')
+        elif table != 'contact_submission':
+            row['ip_address'] = pack_ip('::')
+        else:
+            row['ip_address'] = None
+        converted.append(row)
+
+    if converted:
+        names = list(converted[0].keys())
+        conn.execute(text(
+            f"INSERT INTO {compact_table} ({', '.join(names)}) VALUES ({', '.join(':' + name for name in names)})"
+        ), converted)
+    conn.execute(text(f"DROP TABLE {table}"))
+    conn.execute(text(f"ALTER TABLE {compact_table} RENAME TO {table}"))
+    if table in TABLES:
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table}_location_id ON {table} (location_id)"))
+    if invalid_ips:
+        logger.warning(f"{invalid_ips} unparseable IP addresses in {table} were stored as '::'")
+    logger.info(f"Rebuilt {table} with {len(converted)} rows in the compact layout")
+
+
+def storage_report(conn):
+    """
+    Row count, average bytes per row and table/index sizes for the migrated tables
+    """
+    report = []
+    tables = _tables(conn) + ['location']
+    if db.engine.dialect.name == 'postgresql':
+        for table in tables:
+            rows, row_bytes = conn.execute(text(f"SELECT count(*), avg(pg_column_size(t.*)) FROM {table} t")).one()
+            table_bytes, index_bytes = conn.execute(text(
+                "SELECT coalesce(sum(pg_table_size(relid)), 0), coalesce(sum(pg_indexes_size(relid)), 0) "
+                "FROM pg_partition_tree(CAST(:table AS regclass))"
+            ), {'table': table}).one()
+            report.append((table, rows, row_bytes, table_bytes, index_bytes))
+        return report
+
+    index_tables = dict(conn.execute(text("SELECT name, tbl_name FROM sqlite_master WHERE type = 'index'")).all())
+    try:
+        pages = conn.execute(text(
+            "SELECT name, sum(pgsize), sum(CASE WHEN pagetype = 'leaf' THEN payload END), "
+            "sum(CASE WHEN pagetype = 'leaf' THEN ncell END) FROM dbstat GROUP BY name"
+        )).all()
+    except Exception:
+        # SQLite built without the dbstat virtual table
+        pages = []
+    sizes = {}
+    for name, size, payload, cells in pages:
+        owner = index_tables.get(name, name)
+        entry = sizes.setdefault(owner, {'table': 0, 'index': 0, 'row_bytes': None})
+        if name in index_tables:
+            entry['index'] += size
+        else:
+            entry['table'] += size
+            entry['row_bytes'] = payload / cells if cells else None
+    for table in tables:
+        rows = conn.execute(text(f"SELECT count(*) FROM {table}")).scalar()
+        entry = sizes.get(table, {})
+        report.append((table, rows, entry.get('row_bytes'), entry.get('table'), entry.get('index')))
+    return report
+
+
+def print_storage_report(title):
+    with app.app_context(), db.engine.connect() as conn:
+        print(title)
+        print(f"{'table':<24}{'rows':>10}{'bytes/row':>12}{'table bytes':>14}{'index bytes':>14}")
+        for table, rows, row_bytes, table_bytes, index_bytes in storage_report(conn):
+            row_bytes = f"{row_bytes:.1f}" if row_bytes is not None else 'n/a'
+            print(f"{table:<24}{rows:>10}{row_bytes:>12}{table_bytes if table_bytes is not None else 'n/a':>14}"
+                  f"{index_bytes if index_bytes is not None else 'n/a':>14}")
+
+
+def migrate_compact_storage():
+    """
+    Convert visitor and contact_submission rows to binary IPs and location references
+    """
+    with app.app_context():
+        db.create_all()
+        with db.engine.begin() as conn:
+            for table in _tables(conn):
+                if db.engine.dialect.name == 'postgresql':
+                    migrate_postgresql(conn, table)
+                else:
+                    migrate_sqlite(conn, table)
+        if db.engine.dialect.name == 'sqlite':
+            # VACUUM cannot run inside a transaction
+            connection = db.engine.raw_connection()
+            try:
+                connection.execute("VACUUM")
+            finally:
+                connection.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'report':
+        print_storage_report("Storage")
+    else:
+        print_storage_report("Before migration")
+        migrate_compact_storage()
+        print_storage_report("After migration")
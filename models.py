@@ -1,23 +1,227 @@
+import ipaddress
+import logging
 from datetime import datetime
+from sqlalchemy import case, event
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import Session, declared_attr
+from sqlalchemy.orm.attributes import flag_dirty
+from sqlalchemy.types import TypeDecorator
 from app import db
 
-class Visitor(db.Model):
+logger = logging.getLogger(__name__)
+
+LOCATION_FIELDS = ('country', 'region', 'city')
+
+# Primary key of the single visitor_counter row
+COUNTER_ID = 1
+
+
+def pack_ip(value):
+    """
+    16-byte form of an IP address, IPv4 addresses are stored IPv4-mapped
+    """
+    address = ipaddress.ip_address(value)
+    if address.version == 4:
+        address = ipaddress.IPv6Address(f'::ffff:{address}')
+    return address.packed
+
+
+def unpack_ip(value):
+    address = ipaddress.IPv6Address(bytes(value))
+    return str(address.ipv4_mapped or address)
+
+
+class IPAddress(TypeDecorator):
+    """
+    IP address string stored as INET on PostgreSQL and as 16 packed bytes elsewhere
+    """
+    impl = db.LargeBinary
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(postgresql.INET())
+        return dialect.type_descriptor(db.LargeBinary(16))
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        try:
+            address = ipaddress.ip_address(value)
+        except ValueError:
+            # Unix sockets, test clients and the like, keep the row like migrate_compact_storage.py does
+            logger.warning(f"Storing unparseable IP address {value!r} as '::'")
+            address = ipaddress.ip_address('::')
+        if dialect.name == 'postgresql':
+            return str(address)
+        return pack_ip(address)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        if dialect.name == 'postgresql':
+            return str(value)
+        return unpack_ip(value)
+
+
+class Location(db.Model):
+    """
+    Deduplicated country/region/city triple referenced by visitors and contact submissions.
+    Missing parts are stored as '' so the unique constraint also covers them.
+    """
+    __tablename__ = 'location'
+    __table_args__ = (db.UniqueConstraint('country', 'region', 'city'),)
+    id = db.Column(db.Integer, primary_key=True)
+    country = db.Column(db.String(100), nullable=False, default='')
+    region = db.Column(db.String(100), nullable=False, default='')
+    city = db.Column(db.String(100), nullable=False, default='')
+
+    @classmethod
+    def resolve(cls, session, country, region, city):
+        """
+        Get or create the Location for a triple, safe against concurrent inserts
+        """
+        values = {'country': country, 'region': region, 'city': city}
+        with session.no_autoflush:
+            location = session.query(cls).filter_by(**values).one_or_none()
+            if location is not None:
+                return location
+
+            dialect = session.get_bind().dialect.name
+            if dialect in ('postgresql', 'sqlite'):
+                insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+                session.execute(insert(cls).values(**values).on_conflict_do_nothing())
+                return session.query(cls).filter_by(**values).one()
+
+            location = cls(**values)
+            session.add(location)
+            return location
+
+
+def _location_attribute(name):
+    """
+    Plain read/write attribute backed by the row's Location
+    """
+    def getter(self):
+        pending = self.__dict__.get('_pending_location')
+        if pending is not None:
+            return pending[name]
+        if self.location is None:
+            return None
+        return getattr(self.location, name) or None
+
+    def setter(self, value):
+        pending = self.__dict__.get('_pending_location')
+        if pending is None:
+            pending = {field: getattr(self, field) for field in LOCATION_FIELDS}
+            self.__dict__['_pending_location'] = pending
+        pending[name] = value
+        # The pending values are not a mapped attribute, make sure the flush still sees the row
+        flag_dirty(self)
+
+    def expression(cls):
+        return (db.select(getattr(Location, name))
+                .where(Location.id == cls.location_id)
+                .scalar_subquery())
+
+    return hybrid_property(getter, setter, expr=expression)
+
+
+class LocatedMixin:
+    """
+    Stores country/region/city as a reference to a shared Location row
+    """
+
+    @declared_attr
+    def location_id(cls):
+        return db.Column(db.Integer, db.ForeignKey('location.id'), index=True)
+
+    @declared_attr
+    def location(cls):
+        return db.relationship(Location, lazy='joined')
+
+    country = _location_attribute('country')
+    region = _location_attribute('region')
+    city = _location_attribute('city')
+
+
+@event.listens_for(Session, 'before_flush')
+def resolve_locations(session, flush_context, instances):
+    """
+    Swap location values set on new or changed rows for their Location reference
+    """
+    resolved = {}
+    for obj in list(session.new) + list(session.dirty):
+        pending = obj.__dict__.pop('_pending_location', None) if isinstance(obj, LocatedMixin) else None
+        if pending is None:
+            continue
+        if not any(pending.values()):
+            obj.location = None
+            continue
+        key = tuple(pending[field] or '' for field in LOCATION_FIELDS)
+        if key not in resolved:
+            resolved[key] = Location.resolve(session, *key)
+        obj.location = resolved[key]
+
+
+class Visitor(LocatedMixin, db.Model):
     __tablename__ = 'visitor'
     id = db.Column(db.Integer, primary_key=True)
-    ip_address = db.Column(db.String(50), nullable=False)
+    ip_address = db.Column(IPAddress, nullable=False)
     visit_time = db.Column(db.DateTime, default=datetime.utcnow)
-    country = db.Column(db.String(100))
-    city = db.Column(db.String(100))
-    region = db.Column(db.String(100))
 
-class ContactSubmission(db.Model):
+class ContactSubmission(LocatedMixin, db.Model):
     __tablename__ = 'contact_submission'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     email = db.Column(db.String(120), nullable=False)
     message = db.Column(db.Text, nullable=False)
     submission_time = db.Column(db.DateTime, default=datetime.utcnow)
-    ip_address = db.Column(db.String(50))
+    ip_address = db.Column(IPAddress)
+
+class VisitorRollup(db.Model):
+    """
+    Monthly visit counts kept after a month of visitor rows is archived, see retention.py
+    """
+    __tablename__ = 'visitor_rollup'
+    id = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.Date, nullable=False, index=True)
     country = db.Column(db.String(100))
     city = db.Column(db.String(100))
     region = db.Column(db.String(100))
+    visits = db.Column(db.Integer, nullable=False)
+
+class VisitorSketch(db.Model):
+    """
+    HyperLogLog sketch of the visitor IPs seen on a day, per country ('' for all), see sketches.py
+    """
+    __tablename__ = 'visitor_sketch'
+    day = db.Column(db.Date, primary_key=True)
+    country = db.Column(db.String(100), primary_key=True)
+    registers = db.Column(db.LargeBinary, nullable=False)
+
+class VisitorCounter(db.Model):
+    """
+    Single row tracking the visitor row count and highest id, see stats_cache.py
+    """
+    __tablename__ = 'visitor_counter'
+    id = db.Column(db.Integer, primary_key=True)
+    row_count = db.Column(db.Integer, nullable=False, default=0)
+    max_id = db.Column(db.Integer, nullable=False, default=0)
+
+
+@event.listens_for(Visitor, 'after_insert')
+def bump_visitor_counter(mapper, connection, target):
+    """
+    Keep the visitor counter current in the same transaction as the insert
+    """
+    counter = VisitorCounter.__table__
+    connection.execute(
+        counter.update()
+        .where(counter.c.id == COUNTER_ID)
+        .values(
+            row_count=counter.c.row_count + 1,
+            max_id=case((counter.c.max_id < target.id, target.id), else_=counter.c.max_id),
+        )
+    )
@@ -0,0 +1,498 @@
+"""
+Retention for the append-only visitor table.
+
+Visits are partitioned by calendar month. On PostgreSQL `visitor` becomes a
+natively range-partitioned table with one `visitor_YYYY_MM` partition per
+month; on SQLite months that leave the retention window are rotated out of
+`visitor` into `visitor_YYYY_MM` tables. Months older than RETENTION_MONTHS
+are then compacted: their rows are written to a gzipped, column-oriented
+archive file under ARCHIVE_DIR, summarised into `visitor_rollup` rows and
+dropped from the hot table.
+
+visits_by_country() and iter_visits() combine hot, rotated and archived data
+for historical reports.
+
+Usage:
+    python retention.py migrate   # one-off: convert visitor to a partitioned table (PostgreSQL)
+    python retention.py run       # create upcoming partitions, rotate and compact old months
+"""
+import gzip
+import json
+import logging
+import os
+import sys
+from collections import Counter
+from datetime import date, datetime
+from sqlalchemy import text
+from app import app, db
+from config import ARCHIVE_DIR, RETENTION_MONTHS
+from models import LOCATION_FIELDS, Location, Visitor, VisitorRollup, unpack_ip
+from stats_cache import refresh_counter
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def month_start(value):
+    return date(value.year, value.month, 1)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f"visitor_{month.year:04d}_{month.month:02d}"
+
+
+def parse_partition_name(name):
+    try:
+        _, year, month = name.split('_')
+        return date(int(year), int(month), 1)
+    except ValueError:
+        return None
+
+
+def archive_path(month):
+    return os.path.join(ARCHIVE_DIR, f"{partition_name(month)}.json.gz")
+
+
+def retention_cutoff(today=None):
+    """
+    First month that is still kept in the hot table
+    """
+    return add_months(month_start(today or datetime.utcnow()), -RETENTION_MONTHS)
+
+
+def _dialect():
+    return db.engine.dialect.name
+
+
+def _partition_tables(conn):
+    """
+    Month partitions (PostgreSQL) or rotated tables (SQLite) currently present, by month
+    """
+    if _dialect() == 'postgresql':
+        rows = conn.execute(text(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = 'visitor'"
+        ))
+    else:
+        rows = conn.execute(text(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'visitor\\_%' ESCAPE '\\'"
+        ))
+    tables = {}
+    for (name,) in rows:
+        month = parse_partition_name(name)
+        if month is not None:
+            tables[month] = name
+    return tables
+
+
+# ---------------------------------------------------------------------------
+# Partitioning
+# ---------------------------------------------------------------------------
+
+def is_partitioned(conn):
+    return conn.execute(text(
+        "SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid "
+        "WHERE c.relname = 'visitor'"
+    )).first() is not None
+
+
+def _default_months(conn, before=None):
+    """
+    Months with rows in the default partition, i.e. visits whose partition was not created in time
+    """
+    if conn.execute(text("SELECT to_regclass('visitor_default')")).scalar() is None:
+        return []
+    query = "SELECT DISTINCT date_trunc('month', visit_time) FROM visitor_default"
+    params = {}
+    if before is not None:
+        query += " WHERE visit_time < :before"
+        params['before'] = before
+    return sorted(month_start(row[0]) for row in conn.execute(text(query), params))
+
+
+def create_partition(conn, month):
+    """
+    Create a month partition, moving that month's rows out of the default partition
+    """
+    table = partition_name(month)
+    if conn.execute(text("SELECT to_regclass(:table)"), {'table': table}).scalar() is not None:
+        return
+    bounds = {'start': month, 'end': add_months(month, 1)}
+    create = (
+        f"CREATE TABLE {table} PARTITION OF visitor "
+        f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+    )
+    if month not in _default_months(conn):
+        conn.execute(text(create))
+        return
+
+    # PostgreSQL refuses the new partition while the default one holds rows for it
+    conn.execute(text("ALTER TABLE visitor DETACH PARTITION visitor_default"))
+    conn.execute(text(create))
+    conn.execute(text(
+        "INSERT INTO visitor SELECT * FROM visitor_default WHERE visit_time >= :start AND visit_time < :end"
+    ), bounds)
+    moved = conn.execute(text(
+        "DELETE FROM visitor_default WHERE visit_time >= :start AND visit_time < :end"
+    ), bounds).rowcount
+    conn.execute(text("ALTER TABLE visitor ATTACH PARTITION visitor_default DEFAULT"))
+    logger.info(f"Moved {moved} rows from visitor_default into {table}")
+
+
+def migrate_to_partitioned():
+    """
+    Convert a plain PostgreSQL visitor table into a table partitioned by month
+    """
+    if _dialect() != 'postgresql':
+        logger.info("Native partitioning is PostgreSQL only, SQLite uses rotated tables")
+        return
+
+    with db.engine.begin() as conn:
+        if is_partitioned(conn):
+            logger.info("visitor is already partitioned")
+            return
+
+        conn.execute(text("LOCK TABLE visitor IN ACCESS EXCLUSIVE MODE"))
+        sequence = conn.execute(text("SELECT pg_get_serial_sequence('visitor', 'id')")).scalar()
+        conn.execute(text("ALTER TABLE visitor RENAME TO visitor_legacy"))
+        if sequence:
+            conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY NONE"))
+        conn.execute(text("UPDATE visitor_legacy SET visit_time = CURRENT_TIMESTAMP WHERE visit_time IS NULL"))
+
+        # The partition key has to be part of the primary key
+        conn.execute(text(
+            "CREATE TABLE visitor (LIKE visitor_legacy INCLUDING DEFAULTS) PARTITION BY RANGE (visit_time)"
+        ))
+        conn.execute(text("ALTER TABLE visitor ALTER COLUMN visit_time SET NOT NULL"))
+        conn.execute(text("ALTER TABLE visitor ADD PRIMARY KEY (id, visit_time)"))
+        conn.execute(text("CREATE TABLE IF NOT EXISTS visitor_default PARTITION OF visitor DEFAULT"))
+
+        months = {month_start(row[0]) for row in conn.execute(
+            text("SELECT DISTINCT date_trunc('month', visit_time) FROM visitor_legacy")
+        )}
+        current = month_start(datetime.utcnow())
+        months.update({current, add_months(current, 1)})
+        for month in sorted(months):
+            create_partition(conn, month)
+
+        conn.execute(text("INSERT INTO visitor SELECT * FROM visitor_legacy"))
+        if sequence:
+            conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY visitor.id"))
+        conn.execute(text("DROP TABLE visitor_legacy"))
+
+        # LIKE copies neither foreign keys nor indexes, recreate the location reference on the parent
+        has_location = conn.execute(text(
+            "SELECT 1 FROM information_schema.columns WHERE table_name = 'visitor' AND column_name = 'location_id'"
+        )).first()
+        if has_location:
+            conn.execute(text("ALTER TABLE visitor ADD FOREIGN KEY (location_id) REFERENCES location (id)"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_visitor_location_id ON visitor (location_id)"))
+        logger.info(f"Partitioned visitor into {len(months)} monthly partitions")
+
+
+def ensure_partitions(months_ahead=2):
+    """
+    Create partitions for the current and upcoming months (PostgreSQL)
+    """
+    if _dialect() != 'postgresql':
+        return
+    with db.engine.begin() as conn:
+        if not is_partitioned(conn):
+            logger.warning("visitor is not partitioned yet, run `python retention.py migrate`")
+            return
+        current = month_start(datetime.utcnow())
+        months = {add_months(current, offset) for offset in range(months_ahead + 1)}
+        months.update(_default_months(conn))
+        for month in sorted(months):
+            create_partition(conn, month)
+
+
+def rotate_sqlite(cutoff):
+    """
+    Move months before `cutoff` out of the hot SQLite table into visitor_YYYY_MM tables
+    """
+    with db.engine.begin() as conn:
+        months = [row[0] for row in conn.execute(
+            text("SELECT DISTINCT strftime('%Y-%m', visit_time) FROM visitor "
+                 "WHERE visit_time < :cutoff ORDER BY 1"),
+            {'cutoff': cutoff.isoformat()},
+        ) if row[0]]
+        for key in months:
+            month = date(int(key[:4]), int(key[5:7]), 1)
+            table = partition_name(month)
+            conn.execute(text(f"CREATE TABLE IF NOT EXISTS {table} AS SELECT * FROM visitor WHERE 0"))
+            conn.execute(text(
+                f"INSERT INTO {table} SELECT * FROM visitor WHERE strftime('%Y-%m', visit_time) = :key"
+            ), {'key': key})
+            conn.execute(text("DELETE FROM visitor WHERE strftime('%Y-%m', visit_time) = :key"), {'key': key})
+            logger.info(f"Rotated {key} into {table}")
+
+
+# ---------------------------------------------------------------------------
+# Archival
+# ---------------------------------------------------------------------------
+
+def _serialize(value):
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ')
+    if isinstance(value, bytes):
+        return unpack_ip(value)
+    if value is not None and not isinstance(value, (int, float, str)):
+        # INET values from PostgreSQL
+        return str(value)
+    return value
+
+
+def _partition_rows(conn, table):
+    """
+    Rows of a partition as (column names, list of value tuples), with the
+    location reference resolved to its country/region/city
+    """
+    result = conn.execute(text(
+        f"SELECT t.id, t.ip_address, t.visit_time, l.country, l.region, l.city "
+        f"FROM {table} t LEFT JOIN location l ON l.id = t.location_id ORDER BY t.id"
+    ))
+    columns = list(result.keys())
+    return columns, [tuple(None if value == '' else _serialize(value) for value in row) for row in result]
+
+
+def read_archive(month):
+    """
+    Archived rows for a month as a list of dicts, empty if the month has no archive
+    """
+    path = archive_path(month)
+    if not os.path.exists(path):
+        return []
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        archive = json.load(f)
+    columns = archive['columns']
+    data = archive['data']
+    return [dict(zip(columns, values)) for values in zip(*(data[column] for column in columns))]
+
+
+def write_archive(month, rows):
+    """
+    Write rows column by column to a gzipped JSON file, atomically replacing any previous archive
+    """
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    columns = list(dict.fromkeys(column for row in rows for column in row))
+    archive = {
+        'month': month.isoformat(),
+        'columns': columns,
+        'data': {column: [row.get(column) for row in rows] for column in columns},
+    }
+    path = archive_path(month)
+    tmp_path = f"{path}.tmp"
+    with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=9) as f:
+        json.dump(archive, f, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+def compact_month(conn, month, table):
+    """
+    Archive a partition, rebuild the month's rollups and drop the partition
+    """
+    columns, values = _partition_rows(conn, table)
+
+    # Merge with rows archived by an earlier run, e.g. late rows that landed after compaction
+    rows = {row['id']: row for row in read_archive(month)}
+    for row in values:
+        row = dict(zip(columns, row))
+        rows[row['id']] = row
+    rows = [rows[key] for key in sorted(rows)]
+    write_archive(month, rows)
+
+    counts = Counter(tuple(row.get(column) for column in LOCATION_FIELDS) for row in rows)
+    rollup = VisitorRollup.__table__
+    conn.execute(rollup.delete().where(rollup.c.month == month))
+    if counts:
+        conn.execute(rollup.insert(), [
+            dict(zip(LOCATION_FIELDS, location), month=month, visits=visits)
+            for location, visits in counts.items()
+        ])
+
+    if _dialect() == 'postgresql':
+        conn.execute(text(f"ALTER TABLE visitor DETACH PARTITION {table}"))
+    conn.execute(text(f"DROP TABLE {table}"))
+    logger.info(f"Compacted {table}: {len(values)} rows archived, {len(counts)} rollup rows")
+
+
+def compact(cutoff):
+    """
+    Archive and drop every partition for a month before `cutoff`
+    """
+    if _dialect() == 'postgresql':
+        with db.engine.begin() as conn:
+            # Old rows left in the default partition get a month partition and are compacted with it
+            for month in _default_months(conn, before=cutoff):
+                create_partition(conn, month)
+    with db.engine.connect() as conn:
+        tables = _partition_tables(conn)
+    for month, table in sorted(tables.items()):
+        if month < cutoff:
+            with db.engine.begin() as conn:
+                compact_month(conn, month, table)
+
+
+def run_retention(today=None):
+    cutoff = retention_cutoff(today)
+    logger.info(f"Keeping visits from {cutoff.isoformat()} onwards in the hot table")
+    if _dialect() == 'postgresql':
+        ensure_partitions()
+    else:
+        rotate_sqlite(cutoff)
+    compact(cutoff)
+    # Rows left the hot table, so cached visitor stats are out of date
+    refresh_counter()
+
+
+# ---------------------------------------------------------------------------
+# Historical queries
+# ---------------------------------------------------------------------------
+
+def _as_date(value):
+    return value.date() if isinstance(value, datetime) else value
+
+
+def _as_datetime(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime(value.year, value.month, value.day)
+
+
+def _in_range(month, start, end):
+    """
+    Whether any part of `month` falls within [start, end)
+    """
+    return ((start is None or add_months(month, 1) > month_start(start))
+            and (end is None or month < _as_date(end)))
+
+
+def _month_tables():
+    """
+    Archived months and, on SQLite, rotated tables not yet compacted
+    """
+    archived = []
+    if os.path.isdir(ARCHIVE_DIR):
+        for name in os.listdir(ARCHIVE_DIR):
+            if name.endswith('.json.gz'):
+                month = parse_partition_name(name[:-len('.json.gz')])
+                if month is not None:
+                    archived.append(month)
+    rotated = {}
+    if _dialect() == 'sqlite':
+        with db.engine.connect() as conn:
+            rotated = _partition_tables(conn)
+    return sorted(archived), rotated
+
+
+def iter_visits(start=None, end=None):
+    """
+    Yield visits with start <= visit_time < end as dicts, reading archive files,
+    rotated SQLite tables and the hot table in that order
+    """
+    # Dates are accepted like in visits_by_country(), rows are compared as datetimes
+    start, end = _as_datetime(start), _as_datetime(end)
+    archived, rotated = _month_tables()
+
+    def matching(rows):
+        for row in rows:
+            if isinstance(row.get('visit_time'), str):
+                row['visit_time'] = datetime.fromisoformat(row['visit_time'])
+            if (start is None or row['visit_time'] >= start) and (end is None or row['visit_time'] < end):
+                yield row
+
+    for month in archived:
+        if _in_range(month, start, end):
+            yield from matching(read_archive(month))
+
+    for month, table in sorted(rotated.items()):
+        if _in_range(month, start, end):
+            with db.engine.connect() as conn:
+                columns, values = _partition_rows(conn, table)
+            yield from matching(dict(zip(columns, value)) for value in values)
+
+    query = Visitor.query.order_by(Visitor.id)
+    if start is not None:
+        query = query.filter(Visitor.visit_time >= start)
+    if end is not None:
+        query = query.filter(Visitor.visit_time < end)
+    for visitor in query.yield_per(1000):
+        yield {
+            'id': visitor.id,
+            'ip_address': visitor.ip_address,
+            'visit_time': visitor.visit_time,
+            'country': visitor.country,
+            'city': visitor.city,
+            'region': visitor.region,
+        }
+
+
+def archived_visits():
+    """
+    Number of visits in compacted months, so totals do not drop when a month is archived
+    """
+    return db.session.query(db.func.coalesce(db.func.sum(VisitorRollup.visits), 0)).scalar()
+
+
+def archived_visits_by_country():
+    counts = Counter()
+    rollups = db.session.query(VisitorRollup.country, db.func.sum(VisitorRollup.visits))
+    for country, visits in rollups.group_by(VisitorRollup.country):
+        counts[country or 'Unknown'] += visits
+    return counts
+
+
+def visits_by_country(start=None, end=None):
+    """
+    Visit counts per country across hot and archived data.
+
+    Archived and rotated months are counted whole, so there `start` and `end`
+    are rounded out to month boundaries; hot rows are filtered exactly.
+    """
+    counts = Counter()
+
+    rollups = db.session.query(VisitorRollup.country, db.func.sum(VisitorRollup.visits))
+    if start is not None:
+        rollups = rollups.filter(VisitorRollup.month >= month_start(start))
+    if end is not None:
+        rollups = rollups.filter(VisitorRollup.month < _as_date(end))
+    for country, visits in rollups.group_by(VisitorRollup.country):
+        counts[country or 'Unknown'] += visits
+
+    _, rotated = _month_tables()
+    for month, table in rotated.items():
+        if _in_range(month, start, end):
+            with db.engine.connect() as conn:
+                for country, visits in conn.execute(text(
+                    f"SELECT l.country, COUNT(*) FROM {table} t "
+                    f"LEFT JOIN location l ON l.id = t.location_id GROUP BY l.country"
+                )):
+                    counts[country or 'Unknown'] += visits
+
+    hot = db.session.query(Location.country, db.func.count(Visitor.id)).outerjoin(Visitor.location)
+    if start is not None:
+        hot = hot.filter(Visitor.visit_time >= start)
+    if end is not None:
+        hot = hot.filter(Visitor.visit_time < end)
+    for country, visits in hot.group_by(Location.country):
+        counts[country or 'Unknown'] += visits
+    return dict(counts)
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else 'run'
+    with app.app_context():
+        if command == 'migrate':
+            migrate_to_partitioned()
+        elif command == 'run':
+            run_retention()
+        else:
+            sys.exit(__doc__)
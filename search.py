@@ -0,0 +1,168 @@
+"""
+Full-text search over contact submissions (name, email and message).
+
+SQLite uses an external-content FTS5 table kept in sync by triggers;
+PostgreSQL uses a generated tsvector column with a GIN index. Both are
+maintained by the database on insert, so the ORM needs no changes.
+
+Common terms can match a large share of all submissions, so a query only
+counts and ranks the newest MAX_CANDIDATES matches: the total stops there
+(reported with total_capped) and results are the best of those candidates.
+
+Usage:
+    python search.py "query" [page]
+"""
+import json
+import logging
+import sys
+from sqlalchemy import text
+from app import app, db
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MAX_PER_PAGE = 100
+MAX_CANDIDATES = 1000
+
+SQLITE_INDEX = [
+    """
+    CREATE VIRTUAL TABLE contact_submission_fts USING fts5(
+        name, email, message,
+        content='contact_submission', content_rowid='id', tokenize='unicode61'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS contact_submission_fts_insert AFTER INSERT ON contact_submission BEGIN
+        INSERT INTO contact_submission_fts (rowid, name, email, message)
+        VALUES (new.id, new.name, new.email, new.message);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS contact_submission_fts_delete AFTER DELETE ON contact_submission BEGIN
+        INSERT INTO contact_submission_fts (contact_submission_fts, rowid, name, email, message)
+        VALUES ('delete', old.id, old.name, old.email, old.message);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS contact_submission_fts_update AFTER UPDATE ON contact_submission BEGIN
+        INSERT INTO contact_submission_fts (contact_submission_fts, rowid, name, email, message)
+        VALUES ('delete', old.id, old.name, old.email, old.message);
+        INSERT INTO contact_submission_fts (rowid, name, email, message)
+        VALUES (new.id, new.name, new.email, new.message);
+    END
+    """,
+]
+
+POSTGRESQL_INDEX = [
+    """
+    ALTER TABLE contact_submission ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('simple', coalesce(name, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(email, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(message, '')), 'B')
+    ) STORED
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_contact_submission_search ON contact_submission USING GIN (search_vector)",
+]
+
+
+def ensure_search_index():
+    """
+    Create the search index if missing, building it from existing submissions
+    """
+    with db.engine.begin() as conn:
+        if db.engine.dialect.name == 'postgresql':
+            for statement in POSTGRESQL_INDEX:
+                conn.execute(text(statement))
+            return
+
+        exists = conn.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE name = 'contact_submission_fts'"
+        )).first()
+        statements = SQLITE_INDEX[1:] if exists else SQLITE_INDEX
+        for statement in statements:
+            conn.execute(text(statement))
+        if not exists:
+            conn.execute(text("INSERT INTO contact_submission_fts (contact_submission_fts) VALUES ('rebuild')"))
+            logger.info("Built contact submission search index")
+
+
+def _fts5_query(query):
+    """
+    Quote every term so user input is matched literally instead of as FTS5 syntax
+    """
+    return ' '.join('"{}"'.format(term.replace('"', '""')) for term in query.split())
+
+
+def search_submissions(query, page=1, per_page=20):
+    """
+    Contact submissions matching all terms of `query`, best matches first
+    """
+    page = max(page, 1)
+    per_page = min(max(per_page, 1), MAX_PER_PAGE)
+    result = {'query': query, 'page': page, 'per_page': per_page, 'total': 0, 'total_capped': False, 'results': []}
+    if not query or not query.strip():
+        return result
+
+    params = {
+        'limit': per_page,
+        'offset': (page - 1) * per_page,
+        'candidates': MAX_CANDIDATES,
+        # One more than the cap tells whether there are more matches
+        'count_limit': MAX_CANDIDATES + 1,
+    }
+    if db.engine.dialect.name == 'postgresql':
+        params['query'] = query
+        total_sql = (
+            "SELECT count(*) FROM (SELECT 1 FROM contact_submission "
+            "WHERE search_vector @@ websearch_to_tsquery('simple', :query) LIMIT :count_limit) m"
+        )
+        rows_sql = (
+            "SELECT c.id, c.name, c.email, c.message, c.submission_time, "
+            "ts_rank_cd(c.search_vector, q) AS rank "
+            "FROM (SELECT * FROM contact_submission "
+            "WHERE search_vector @@ websearch_to_tsquery('simple', :query) "
+            "ORDER BY id DESC LIMIT :candidates) c, websearch_to_tsquery('simple', :query) q "
+            "ORDER BY rank DESC, c.id DESC LIMIT :limit OFFSET :offset"
+        )
+    else:
+        params['query'] = _fts5_query(query)
+        total_sql = (
+            "SELECT count(*) FROM (SELECT 1 FROM contact_submission_fts "
+            "WHERE contact_submission_fts MATCH :query LIMIT :count_limit)"
+        )
+        # bm25 is lower for better matches, name and email hits weigh more than the message
+        rows_sql = (
+            "SELECT c.id, c.name, c.email, c.message, c.submission_time, m.rank "
+            "FROM (SELECT rowid, -bm25(contact_submission_fts, 10.0, 10.0, 1.0) AS rank "
+            "FROM contact_submission_fts WHERE contact_submission_fts MATCH :query "
+            "ORDER BY rowid DESC LIMIT :candidates) m "
+            "JOIN contact_submission c ON c.id = m.rowid "
+            "ORDER BY m.rank DESC, c.id DESC LIMIT :limit OFFSET :offset"
+        )
+
+    with db.engine.connect() as conn:
+        total = conn.execute(text(total_sql), params).scalar()
+        result['total'] = min(total, MAX_CANDIDATES)
+        result['total_capped'] = total > MAX_CANDIDATES
+        for row in conn.execute(text(rows_sql), params).mappings():
+            submission_time = row['submission_time']
+            result['results'].append({
+                'id': row['id'],
+                'name': row['name'],
+                'email': row['email'],
+                'message': row['message'],
+                'submission_time': str(submission_time) if submission_time is not None else None,
+                'rank': float(row['rank']),
+            })
+    return result
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+    with app.app_context():
+        ensure_search_index()
+        page = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+        print(json.dumps(search_submissions(sys.argv[1], page=page), indent=2))
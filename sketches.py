@@ -0,0 +1,339 @@
+"""
+Approximate unique-visitor counts with HyperLogLog sketches.
+
+Every committed visit adds its IP address to two sketches for the day of the
+visit: one for all countries and one for the visitor's country. Sketches are
+kept in memory per process and merged into `visitor_sketch` rows every
+SKETCH_FLUSH_INTERVAL seconds. Merging takes the per-register maximum, so
+sketches from different workers, and from any set of days, combine into the
+sketch of the union without double counting.
+
+Error bounds: with 2**SKETCH_PRECISION registers the relative standard error
+is 1.04 / sqrt(2**SKETCH_PRECISION), 1.6% for the default precision of 12,
+so about 95% of estimates fall within twice that (3.3%) of the true count.
+Small counts are corrected with linear counting and are close to exact.
+
+Reading many days means merging many sketches, so merged sketches of
+completed months are kept in memory for MONTH_CACHE_TTL seconds, and each
+unique_visitors() result is reused until the next flush or for at most
+SKETCH_FLUSH_INTERVAL seconds, which is how stale the stored sketches can
+be anyway.
+
+Usage:
+    python sketches.py backfill   # add existing visits, including archived months
+"""
+import atexit
+import hashlib
+import logging
+import math
+import sys
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from app import app, db
+from background import LazyThread
+from config import SKETCH_FLUSH_INTERVAL, SKETCH_PRECISION
+from models import Visitor, VisitorSketch
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+ALL_COUNTRIES = ''
+# Longest range unique_visitors() is asked for by the site
+MAX_DAYS = 90
+# Completed months only change through a backfill
+MONTH_CACHE_TTL = 3600
+
+# 2 ** -rank for every possible register value
+INVERSE_POWERS = [2.0 ** -rank for rank in range(65)]
+
+
+class HyperLogLog:
+    """
+    HyperLogLog cardinality sketch over 64-bit blake2b hashes
+    """
+
+    def __init__(self, precision=SKETCH_PRECISION, registers=None):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(registers) if registers is not None else bytearray(self.size)
+
+    @property
+    def relative_error(self):
+        return 1.04 / math.sqrt(self.size)
+
+    def add(self, value):
+        digest = hashlib.blake2b(str(value).encode(), digest_size=8).digest()
+        hashed = int.from_bytes(digest, 'big')
+        index = hashed >> (64 - self.precision)
+        rest = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge sketches of different precision")
+        # Per-register max on the registers packed into one integer: registers
+        # never reach 128, so (a | 0x80) - b keeps the high bit exactly where a >= b
+        size = self.size
+        a = int.from_bytes(self.registers, 'big')
+        b = int.from_bytes(other.registers, 'big')
+        high = int.from_bytes(b'\x80' * size, 'big')
+        keep = ((((a | high) - b) & high) >> 7) * 0xFF
+        self.registers = bytearray(((a & keep) | (b & ~keep)).to_bytes(size, 'big'))
+        return self
+
+    def copy(self):
+        return HyperLogLog(self.precision, self.registers)
+
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        estimate = alpha * self.size * self.size / sum(map(INVERSE_POWERS.__getitem__, self.registers))
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.size and zeros:
+            # Linear counting is more accurate for small cardinalities
+            estimate = self.size * math.log(self.size / zeros)
+        return round(estimate)
+
+    def to_bytes(self):
+        # Mostly-empty sketches compress very well
+        return zlib.compress(bytes(self.registers))
+
+    @classmethod
+    def from_bytes(cls, data):
+        registers = zlib.decompress(data)
+        return cls(precision=len(registers).bit_length() - 1, registers=registers)
+
+
+class SketchBuffer:
+    """
+    Per-process sketches waiting to be merged into the database
+    """
+
+    def __init__(self, flush_interval=SKETCH_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._sketches = {}
+        self._lock = threading.Lock()
+        self._thread = LazyThread(self._run, 'sketch-flush')
+
+    def add(self, ip_address, country, day):
+        with self._lock:
+            for key in ((day, ALL_COUNTRIES), (day, country or 'Unknown')):
+                sketch = self._sketches.get(key)
+                if sketch is None:
+                    sketch = self._sketches[key] = HyperLogLog()
+                sketch.add(ip_address)
+        self._thread.ensure_started()
+
+    def pending(self):
+        with self._lock:
+            return {key: HyperLogLog(registers=sketch.registers) for key, sketch in self._sketches.items()}
+
+    def flush(self):
+        """
+        Merge buffered sketches into their visitor_sketch rows
+        """
+        with self._lock:
+            sketches, self._sketches = self._sketches, {}
+        if not sketches:
+            return
+        try:
+            with app.app_context():
+                merge_into_database(sketches)
+            # Stored sketches changed, recompute cached estimates
+            with _cache_lock:
+                _result_cache.clear()
+        except Exception as e:
+            logger.error(f"Error flushing visitor sketches: {str(e)}")
+            # Keep them for the next flush, merging is idempotent
+            with self._lock:
+                for key, sketch in sketches.items():
+                    if key in self._sketches:
+                        sketch.merge(self._sketches[key])
+                    self._sketches[key] = sketch
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+
+def merge_into_database(sketches):
+    """
+    Merge {(day, country): HyperLogLog} into the stored sketches
+    """
+    for attempt in range(2):
+        try:
+            # In SQLite mode take the write lock up front, the rows are read before they are written
+            connection = db.engine.connect().execution_options(sqlite_begin='BEGIN IMMEDIATE')
+            with connection, Session(bind=connection) as session, session.begin():
+                for (day, country), sketch in sorted(sketches.items()):
+                    row = (session.query(VisitorSketch)
+                           .filter_by(day=day, country=country)
+                           .with_for_update()
+                           .one_or_none())
+                    if row is None:
+                        session.add(VisitorSketch(day=day, country=country, registers=sketch.to_bytes()))
+                    else:
+                        row.registers = HyperLogLog.from_bytes(row.registers).merge(sketch).to_bytes()
+            return
+        except IntegrityError:
+            # Another worker created one of the rows first, merge into it instead
+            if attempt:
+                raise
+
+
+buffer = SketchBuffer()
+atexit.register(buffer.flush)
+
+
+@event.listens_for(Visitor, 'after_insert')
+def collect_visit(mapper, connection, target):
+    # Only counted once the transaction commits
+    Session.object_session(target).info.setdefault('sketch_visits', []).append(
+        (target.ip_address, target.country, (target.visit_time or datetime.utcnow()).date())
+    )
+
+
+@event.listens_for(Session, 'after_commit')
+def record_visits(session):
+    for visit in session.info.pop('sketch_visits', []):
+        buffer.add(*visit)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_visits(session):
+    session.info.pop('sketch_visits', None)
+
+
+_cache_lock = threading.Lock()
+# month -> (loaded at, {country: HyperLogLog})
+_month_cache = {}
+# (days, end) -> (computed at, unique_visitors() result)
+_result_cache = {}
+
+
+def _next_month(day):
+    return (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+def _merge_into(merged, sketches):
+    for key, sketch in sketches:
+        if key in merged:
+            merged[key].merge(sketch)
+        else:
+            # Copied, the sketch may be a cached one
+            merged[key] = sketch.copy()
+
+
+def _stored(start, end):
+    """
+    Stored sketches for start <= day <= end merged per country
+    """
+    merged = {}
+    query = db.session.query(VisitorSketch).filter(VisitorSketch.day >= start, VisitorSketch.day <= end)
+    _merge_into(merged, ((row.country, HyperLogLog.from_bytes(row.registers)) for row in query))
+    return merged
+
+
+def _month_sketches(month):
+    """
+    Stored sketches of a completed month merged per country, cached
+    """
+    with _cache_lock:
+        cached = _month_cache.get(month)
+    if cached is not None and time.monotonic() - cached[0] < MONTH_CACHE_TTL:
+        return cached[1]
+    sketches = _stored(month, _next_month(month) - timedelta(days=1))
+    with _cache_lock:
+        _month_cache[month] = (time.monotonic(), sketches)
+    return sketches
+
+
+def _merged(start, end):
+    """
+    Sketches for start <= day <= end merged per country, including unflushed local ones
+    """
+    merged = {}
+    current_month = datetime.utcnow().date().replace(day=1)
+    day = start
+    while day <= end:
+        month_end = _next_month(day) - timedelta(days=1)
+        if day.day == 1 and month_end <= end and day < current_month:
+            _merge_into(merged, _month_sketches(day).items())
+            day = month_end + timedelta(days=1)
+        else:
+            # Partial or current month, read its days directly
+            chunk_end = min(month_end, end)
+            _merge_into(merged, _stored(day, chunk_end).items())
+            day = chunk_end + timedelta(days=1)
+    _merge_into(merged, ((country, sketch) for (day, country), sketch in buffer.pending().items()
+                         if start <= day <= end))
+    return merged
+
+
+def unique_visitors(days=30, today=None):
+    """
+    Estimated distinct visitor IPs over the last `days` days, overall and per country
+    """
+    end = today or datetime.utcnow().date()
+    with _cache_lock:
+        cached = _result_cache.get((days, end))
+    if cached is not None and time.monotonic() - cached[0] < SKETCH_FLUSH_INTERVAL:
+        return cached[1]
+
+    start = end - timedelta(days=days - 1)
+    merged = _merged(start, end)
+    overall = merged.pop(ALL_COUNTRIES, None)
+    relative_error = HyperLogLog().relative_error
+    result = {
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'unique_visitors': overall.count() if overall else 0,
+        'by_country': dict(sorted(
+            ((country, sketch.count()) for country, sketch in merged.items()),
+            key=lambda item: item[1],
+            reverse=True,
+        )),
+        'relative_standard_error': round(relative_error, 4),
+        'error_bound_95': round(2 * relative_error, 4),
+    }
+    with _cache_lock:
+        now = time.monotonic()
+        for key in [key for key, (computed_at, _) in _result_cache.items()
+                    if now - computed_at >= SKETCH_FLUSH_INTERVAL]:
+            del _result_cache[key]
+        _result_cache[(days, end)] = (now, result)
+    return result
+
+
+def backfill():
+    """
+    Add every stored visit, including archived months, to the sketches
+    """
+    from retention import iter_visits
+
+    sketches = {}
+    visits = 0
+    for visit in iter_visits():
+        if not visit.get('ip_address') or visit.get('visit_time') is None:
+            continue
+        day = visit['visit_time'].date()
+        for key in ((day, ALL_COUNTRIES), (day, visit.get('country') or 'Unknown')):
+            sketches.setdefault(key, HyperLogLog()).add(visit['ip_address'])
+        visits += 1
+    merge_into_database(sketches)
+    logger.info(f"Backfilled {visits} visits into {len(sketches)} sketches")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != 'backfill':
+        sys.exit(__doc__)
+    with app.app_context():
+        backfill()
@@ -0,0 +1,208 @@
+"""
+High-concurrency mode for single-node SQLite deployments.
+
+Every connection runs in WAL mode with synchronous=NORMAL, a busy timeout
+and a larger page cache and mmap window, so readers never block the writer
+or each other. Writes go through one writer thread per process: it takes the
+write lock up front (BEGIN IMMEDIATE), commits queued writes together in a
+single transaction, each in its own savepoint so one failing write does not
+affect the others, and between batches checkpoints the WAL and refreshes the
+planner statistics with ANALYZE.
+
+Writers in different gunicorn workers still queue on SQLite's lock through
+busy_timeout. For a single writer across the whole site, run one worker with
+several threads (gunicorn --workers 1 --threads 16).
+
+The async app (asgi.py) reads through aiosqlite with the same pragmas, and
+its writes go through the same writer thread, see save_async().
+
+Enabled automatically when DATABASE_URL points at SQLite, set SQLITE_MODE=off
+to disable.
+"""
+import asyncio
+import logging
+import queue
+import time
+from concurrent.futures import Future
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from background import LazyThread
+from config import (
+    SQLITE_ANALYZE_INTERVAL,
+    SQLITE_BUSY_TIMEOUT,
+    SQLITE_CACHE_SIZE_KB,
+    SQLITE_CHECKPOINT_INTERVAL,
+    SQLITE_MMAP_SIZE,
+    SQLITE_WRITER_BATCH,
+    SQLITE_WRITE_TIMEOUT,
+)
+
+logger = logging.getLogger(__name__)
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}",
+    f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}",
+    f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}",
+    "PRAGMA temp_store=MEMORY",
+)
+
+
+def configure_sqlite(engine):
+    """
+    Apply the connection pragmas to an engine and take over transaction
+    control from pysqlite, so BEGIN IMMEDIATE and savepoints work
+    """
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for pragma in PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
+    @event.listens_for(engine, 'begin')
+    def begin(conn):
+        conn.exec_driver_sql(conn.get_execution_options().get('sqlite_begin', 'BEGIN'))
+
+
+class SQLiteWriter:
+    """
+    Single writer thread that group-commits queued writes
+    """
+
+    def __init__(self, engine, batch_size=SQLITE_WRITER_BATCH):
+        self.engine = engine
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._thread = LazyThread(self._run, 'sqlite-writer')
+        self._checkpointed_at = time.monotonic()
+        self._analyzed_at = time.monotonic()
+
+    def submit(self, write):
+        """
+        Queue `write(session)` for the writer thread, returns a Future with its result
+        """
+        self._thread.ensure_started()
+        future = Future()
+        self._queue.put((write, future))
+        return future
+
+    def _next_batch(self):
+        try:
+            batch = [self._queue.get(timeout=SQLITE_CHECKPOINT_INTERVAL)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _commit(self, batch):
+        results = []
+        try:
+            with self.engine.connect() as conn:
+                conn = conn.execution_options(sqlite_begin='BEGIN IMMEDIATE')
+                with Session(bind=conn, expire_on_commit=False) as session:
+                    for write, future in batch:
+                        try:
+                            with session.begin_nested():
+                                result = write(session)
+                        except Exception as e:
+                            results.append((future, None, e))
+                        else:
+                            # Only a write whose savepoint flushed cleanly succeeded
+                            results.append((future, result, None))
+                    session.commit()
+                    # Hand the written objects back to the request threads
+                    session.expunge_all()
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def _maintain(self):
+        now = time.monotonic()
+        checkpoint_due = now - self._checkpointed_at >= SQLITE_CHECKPOINT_INTERVAL
+        analyze_due = now - self._analyzed_at >= SQLITE_ANALYZE_INTERVAL
+        if not (checkpoint_due or analyze_due):
+            return
+        # Outside any transaction, a checkpoint cannot run past an open read snapshot
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            if checkpoint_due:
+                self._checkpointed_at = now
+                cursor.execute("PRAGMA wal_checkpoint(PASSIVE)")
+            if analyze_due:
+                self._analyzed_at = now
+                cursor.execute("PRAGMA analysis_limit=1000")
+                cursor.execute("ANALYZE")
+                logger.info("Refreshed SQLite planner statistics")
+            cursor.close()
+        except Exception as e:
+            logger.error(f"Error during SQLite maintenance: {str(e)}")
+        finally:
+            connection.close()
+
+    def _run(self):
+        while True:
+            try:
+                batch = self._next_batch()
+                if batch:
+                    self._commit(batch)
+                self._maintain()
+            except Exception as e:
+                # One bad batch must not stop every later write
+                logger.error(f"Error in SQLite writer: {str(e)}")
+
+
+# Set by enable() when SQLite mode is on
+writer = None
+
+
+def enable(engine):
+    global writer
+    configure_sqlite(engine)
+    writer = SQLiteWriter(engine)
+    logger.info("SQLite mode enabled: WAL journaling and a single writer thread")
+
+
+def save(session, obj):
+    """
+    Insert `obj` and commit, through the writer thread in SQLite mode
+    """
+    if writer is None:
+        session.add(obj)
+        session.commit()
+        return obj
+
+    def add(writer_session):
+        writer_session.add(obj)
+        return obj
+
+    return writer.submit(add).result(SQLITE_WRITE_TIMEOUT)
+
+
+async def save_async(session, obj):
+    """
+    save() for an AsyncSession, waiting on the writer thread without blocking the event loop
+    """
+    if writer is None:
+        session.add(obj)
+        await session.commit()
+        return obj
+
+    def add(writer_session):
+        writer_session.add(obj)
+        return obj
+
+    return await asyncio.wait_for(asyncio.wrap_future(writer.submit(add)), SQLITE_WRITE_TIMEOUT)
@@ -135,6 +135,50 @@ document.addEventListener('DOMContentLoaded', function() {
         return re.test(email);
     }
 
+    // Live visitor counter
+    const visitorStream = document.querySelector('[data-visitor-stream]');
+    const liveCounters = document.querySelectorAll('[data-live-visitors]');
+
+    if (visitorStream && liveCounters.length > 0 && window.EventSource) {
+        const source = new EventSource(visitorStream.dataset.visitorStream);
+        source.addEventListener('counter', function(e) {
+            const data = JSON.parse(e.data);
+            liveCounters.forEach(counter => {
+                counter.textContent = data.total;
+            });
+        });
+    }
+
+    // Unique visitor estimates
+    const uniqueCard = document.querySelector('[data-unique-visitors]');
+
+    if (uniqueCard) {
+        const url = uniqueCard.dataset.uniqueVisitors;
+        Promise.all([
+            fetch(url + '?days=1').then(response => response.json()),
+            fetch(url + '?days=30').then(response => response.json())
+        ]).then(function([today, month]) {
+            uniqueCard.querySelector('[data-unique-today]').textContent = today.unique_visitors;
+            uniqueCard.querySelector('[data-unique-month]').textContent = month.unique_visitors;
+            uniqueCard.querySelector('[data-unique-error]').textContent = (month.error_bound_95 * 100).toFixed(1);
+            const countries = uniqueCard.querySelector('[data-unique-countries]');
+            Object.entries(month.by_country).forEach(([country, count]) => {
+                const item = document.createElement('li');
+                item.className = 'list-group-item bg-dark text-white d-flex justify-content-between';
+                const name = document.createElement('span');
+                name.textContent = country;
+                const badge = document.createElement('span');
+                badge.className = 'badge bg-secondary rounded-pill';
+                badge.textContent = count;
+                item.append(name, badge);
+                countries.appendChild(item);
+            });
+            uniqueCard.classList.remove('d-none');
+        }).catch(function() {
+            // Leave the card hidden when the estimates are unavailable
+        });
+    }
+
     // Initialize Bootstrap tooltips
     var tooltipTriggerList = [].slice.call(document.querySelectorAll('[data-bs-toggle="tooltip"]'));
     var tooltipList = tooltipTriggerList.map(function (tooltipTriggerEl) {
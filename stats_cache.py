@@ -0,0 +1,105 @@
+"""
+Conditional caching for /visitor-stats.
+
+The page only changes when visitor rows do, so it is keyed on a cheap data
+version: the row count and highest id kept in the single-row
+`visitor_counter` table, which models.py bumps in the same transaction as
+every Visitor insert. The version becomes a strong ETag, letting revalidating
+browsers get a 304 without the visitor rows being loaded, and the rendered
+HTML is kept in files under PAGE_CACHE_DIR, shared by all workers. A new
+visit changes the version, so stale pages are never served and old files
+are pruned on the next write. Unique visitor estimates change without new
+rows, so the page loads them from /visitor-stats/unique instead of caching them.
+"""
+import glob
+import logging
+import os
+from datetime import datetime
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+from app import db
+from config import PAGE_CACHE_DIR, PAGE_CACHE_ENTRIES
+from models import COUNTER_ID, Visitor, VisitorCounter
+
+logger = logging.getLogger(__name__)
+
+
+def refresh_counter():
+    """
+    Recompute the counter from the visitor table, after bulk changes such as retention
+    """
+    with db.engine.begin() as conn:
+        row_count, max_id = conn.execute(select(func.count(), func.max(Visitor.id)).select_from(Visitor)).one()
+        counter = VisitorCounter.__table__
+        updated = conn.execute(
+            counter.update().where(counter.c.id == COUNTER_ID).values(row_count=row_count, max_id=max_id or 0)
+        ).rowcount
+        if not updated:
+            conn.execute(counter.insert().values(id=COUNTER_ID, row_count=row_count, max_id=max_id or 0))
+
+
+def ensure_counter():
+    try:
+        if db.session.get(VisitorCounter, COUNTER_ID) is None:
+            refresh_counter()
+    except IntegrityError:
+        # Another worker created the row at the same time
+        pass
+    finally:
+        db.session.remove()
+
+
+def data_version():
+    """
+    Version string that changes whenever visitor rows change (and daily, for the date-based stats)
+    """
+    counter = db.session.get(VisitorCounter, COUNTER_ID)
+    if counter is None:
+        row_count, max_id = db.session.execute(select(func.count(), func.max(Visitor.id)).select_from(Visitor)).one()
+    else:
+        row_count, max_id = counter.row_count, counter.max_id
+    return f"{max_id or 0}-{row_count}-{datetime.utcnow().date():%Y%m%d}"
+
+
+class PageCache:
+    """
+    Rendered pages keyed by data version, stored as files so every worker shares them
+    """
+
+    def __init__(self, name, directory=PAGE_CACHE_DIR, entries=PAGE_CACHE_ENTRIES):
+        self.name = name
+        self.directory = directory
+        self.entries = entries
+
+    def _path(self, version):
+        return os.path.join(self.directory, f"{self.name}-{version}.html")
+
+    def get(self, version):
+        try:
+            with open(self._path(version), encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, version, html):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(version)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(html)
+            os.replace(tmp_path, path)
+            self._prune()
+        except OSError as e:
+            logger.error(f"Error caching {self.name} page: {str(e)}")
+
+    def _prune(self):
+        paths = sorted(glob.glob(os.path.join(self.directory, f"{self.name}-*.html")), key=os.path.getmtime)
+        for path in paths[:-self.entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+visitor_stats_cache = PageCache('visitor_stats')